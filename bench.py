@@ -0,0 +1,144 @@
+'''
+Microbenchmarks for yadt and the store read pipeline.
+
+> python bench.py                          # writes bench_results.json
+> python bench.py --compare old.json       # fails on regressions
+
+Results are machine readable so runs can be compared before a deploy.
+'''
+
+import argparse
+import copy
+from datetime import datetime, timedelta
+import json
+import platform
+import subprocess
+import sys
+import time
+
+from store import last_json
+from store_test import MemoryBlob
+from yadt import (scan_and_apply_tz, utc_to_toronto, ceil_dt, utcnow,
+                  timestamp_cache_clear)
+from yadt_test import lst
+
+HOURLY_SIZES = (24, 96, 384)
+
+
+def hourly_payload(hours):
+    # Synthetic /hourly/ forecast: the realtime fixture repeated hour by hour.
+    start = datetime(2020, 12, 23, 19)
+    payload = []
+    for h in range(hours):
+        item = copy.deepcopy(lst[h % len(lst)])
+        item.pop('name', None)
+        item['observation_time']['value'] = (
+            start + timedelta(hours=h)).strftime('%Y-%m-%dT%H:%M:%S.000Z')
+        payload.append(item)
+    return payload
+
+
+def measure(fn, number, repeat=5, setup=None):
+    timings = []
+    for _ in range(repeat):
+        if setup:
+            setup()
+        begin = time.perf_counter()
+        for _ in range(number):
+            fn()
+        timings.append((time.perf_counter() - begin) / number)
+    return {
+        'number': number,
+        'repeat': repeat,
+        'best': min(timings),
+        'mean': sum(timings) / len(timings),
+    }
+
+
+def benchmarks():
+    naive = datetime(2020, 12, 23, 19, 15, 1)
+    now = utcnow()
+    yield 'utc_to_toronto', lambda: utc_to_toronto(naive), 20000, None
+    yield 'ceil_dt', lambda: ceil_dt(now, 15), 20000, None
+
+    yield 'scan_and_apply_tz/realtime', lambda: scan_and_apply_tz(lst[0]), 2000, None
+    yield ('scan_and_apply_tz/realtime/cold', lambda: scan_and_apply_tz(lst[0]),
+           1, timestamp_cache_clear)
+    yield 'json.dumps/realtime', lambda: json.dumps(lst[0]), 2000, None
+
+    for hours in HOURLY_SIZES:
+        payload = hourly_payload(hours)
+        blob = json.dumps(payload).encode('utf-8')
+        blobs = [MemoryBlob('hourly-20201223-%06d' % i, blob) for i in range(10)]
+        yield ('scan_and_apply_tz/hourly-%d' % hours,
+               lambda p=payload: scan_and_apply_tz(p), 50, None)
+        yield ('scan_and_apply_tz/hourly-%d/cold' % hours,
+               lambda p=payload: scan_and_apply_tz(p), 1, timestamp_cache_clear)
+        yield ('json.dumps/hourly-%d' % hours,
+               lambda p=payload: json.dumps(p), 50, None)
+        yield ('last_json/hourly-%d/10-blobs' % hours,
+               lambda b=blobs: last_json(range(-1, -11, -1), b), 5, None)
+
+    realtime = [MemoryBlob('realtime-20201223-%06d' % i, json.dumps(lst[i % len(lst)]).encode('utf-8'))
+                for i in range(200)]
+    yield ('last_json/realtime/200-blobs',
+           lambda: last_json(range(-1, -201, -1), realtime), 5, None)
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, previous, threshold):
+    regressions = []
+    for name, result in results.items():
+        old = previous.get('results', {}).get(name)
+        if not old:
+            continue
+        ratio = result['best'] / old['best']
+        print('{:45} {:>12.2f}us {:>7.2f}x'.format(name, result['best'] * 1e6, ratio))
+        if ratio > threshold:
+            regressions.append(name)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--output', default='bench_results.json')
+    parser.add_argument('--compare', help='previous results file')
+    parser.add_argument('--threshold', type=float, default=1.25,
+                        help='slowdown ratio reported as a regression')
+    args = parser.parse_args()
+
+    # Read before the run, --output may overwrite the same file.
+    previous = None
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)
+
+    results = {}
+    for name, fn, number, setup in benchmarks():
+        results[name] = measure(fn, number, setup=setup)
+        print('{:45} {:>12.2f}us'.format(name, results[name]['best'] * 1e6))
+
+    with open(args.output, 'w') as f:
+        json.dump({
+            'date': datetime.now().isoformat(),
+            'revision': git_revision(),
+            'python': platform.python_version(),
+            'results': results,
+        }, f, indent=4, sort_keys=True)
+
+    if previous is not None:
+        regressions = compare(results, previous, args.threshold)
+        if regressions:
+            print('Regressions: {}'.format(', '.join(regressions)))
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,14 +1,29 @@
 import os
-from flask import Flask, url_for, request
+from flask import Flask, url_for, request, Response, stream_with_context
 import requests
 import json
 from google.cloud import pubsub_v1
 import time
-from datetime import datetime
+from datetime import datetime, timedelta
+from functools import partial
 from google.cloud import secretmanager
 from google.cloud import storage
 import base64
-from yadt import scan_and_apply_tz
+from yadt import scan_and_apply_tz, timestamp_cache_info
+import threading
+import atexit
+import signal
+from google.api_core.exceptions import PreconditionFailed
+from store import iter_last_json, logged_records, iter_json_array, \
+    iter_ndjson, parse_fields, SlotIndex, parse_datetime, Manifest, BucketBlobs, \
+    observation_time, blob_cache, resolve_range, stamp_name, \
+    read_raw_records, segment_name, aggregate_records, SHARD_PREFIX, \
+    LAYOUTS, name_key, name_stamp, range_bounds, \
+    shard_period, parse_shard, CODECS, compress, zstandard, \
+    forecast_delta, WriteBehind, TZ_SCHEMA, normalize_payload, \
+    decompress, sniff_codec, MANIFEST_PREFIX, update_manifest, append_to_shard, \
+    list_range, list_blob_last, listed_blobs
+from columnar import dumps_segment, BUCKETS, AGGREGATES
 
 
 # Instantiates a client
@@ -24,8 +39,29 @@ topic_id = os.environ['TOPIC_ID']
 
 app = Flask(__name__)
 
+realtime_index = SlotIndex()
+realtime_index_lock = threading.Lock()
 
-def create_file(payload, filename):
+# One manifest object per prefix, see store.Manifest. The last downloaded
+# version of each is kept with its generation.
+manifests = {}
+
+# BLOB_CODEC=gzip|zstd compresses the blobs written, zstd needs the
+# zstandard package and falls back to gzip without it.
+BLOB_CODEC = os.environ.get('BLOB_CODEC', '')
+if BLOB_CODEC and BLOB_CODEC not in CODECS:
+    print("Unknown BLOB_CODEC {}, blobs are written uncompressed.".format(BLOB_CODEC))
+    BLOB_CODEC = ''
+elif BLOB_CODEC == 'zstd' and zstandard is None:
+    print("zstandard is not installed, blobs are written with gzip.")
+    BLOB_CODEC = 'gzip'
+
+# SHARD_PERIOD=hour|day appends each push to the NDJSON shard of its hour
+# or day instead of writing one object per push, see store.append_to_shard().
+SHARD_PERIOD = os.environ.get('SHARD_PERIOD', '')
+
+
+def create_file(payload, filename, schema=None):
     """Create a file.
 
   The retry_params specified in the open call will override the default
@@ -33,11 +69,237 @@ def create_file(payload, filename):
 
   Args:
     filename: filename.
+    schema: TZ_SCHEMA when the timestamps are already in Toronto time.
   """
     blob = bucket.blob(filename)
+    metadata = {}
+    if schema is not None:
+        metadata["schema"] = schema
+
+    if BLOB_CODEC:
+        # Not Content-Encoding, GCS would transcode it on download. The
+        # readers sniff the codec.
+        metadata["codec"] = BLOB_CODEC
+        blob.metadata = metadata
+        blob.upload_from_string(data=compress(payload.encode('utf-8'), BLOB_CODEC),
+                                content_type='application/' + BLOB_CODEC)
+    else:
+        blob.metadata = metadata or None
+        blob.upload_from_string(data=payload,
+                                content_type='text/plain')
+    return blob
+
+
+def load_manifest(prefix):
+    """Current manifest of a prefix, None if it was never built.
+
+    Only the metadata is fetched when the cached copy is still current.
+    """
+    blob = bucket.get_blob(MANIFEST_PREFIX + prefix)
+    if blob is None:
+        return None
+
+    cached = manifests.get(prefix)
+    if cached and cached[1] == blob.generation:
+        return cached[0]
+
+    manifest = Manifest.loads(blob.download_as_string())
+    manifests[prefix] = (manifest, blob.generation)
+    return manifest
+
+
+def rebuild_manifest(prefix):
+    # One time migration, the only place listing the whole prefix.
+    print("Building manifest for {}.".format(prefix))
+    manifest = Manifest(prefix)
+    for _b in storage_client.list_blobs(bucket, prefix=prefix):
+        manifest.add(_b.name, _b.size, generation=_b.generation,
+                     schema=(_b.metadata or {}).get('schema'))
+    # Records appended to shards only exist as lines of their shard.
+    shards = SHARD_PREFIX + prefix + '-'
+    for _b in storage_client.list_blobs(bucket, prefix=shards):
+        period = _b.name[len(shards):-len('.ndjson')]
+        for name in parse_shard(_b.download_as_string()):
+            manifest.add(name, generation=_b.generation)
+        manifest.add_shard(period, _b.name)
+    return manifest
+
+
+def add_to_manifest(prefix, blob, payload, name=None, period=None, schema=None):
+    # `name` and `period` are given for a record appended to the shard
+    # `blob`, the record then lives at that name in the manifest. None when
+    # the manifest couldn't be updated.
+    size = len(payload.encode('utf-8'))
+    name = name or blob.name
+
+    def update(manifest):
+        manifest.add(name, size, observation_time(payload), blob.generation,
+                     schema)
+        if period is not None:
+            manifest.add_shard(period, blob.name)
+
+    return update_manifest(bucket, prefix, update, name, rebuild_manifest)
+
+
+def write_record(prefix, filename, payload, schema=None):
+    # One object per push, or a line of a shard with SHARD_PERIOD. Returns
+    # None when nothing could be written or the manifest not updated, the
+    # record would be invisible to readers.
+    if not SHARD_PERIOD:
+        blob = create_file(payload, filename, schema)
+        if add_to_manifest(prefix, blob, payload, schema=schema) is None:
+            return None
+        return blob
+
+    shard = append_to_shard(bucket, prefix, filename, payload, SHARD_PERIOD, schema)
+    if shard is None:
+        return None
+    if add_to_manifest(prefix, shard, payload, filename,
+                       shard_period(filename, SHARD_PERIOD), schema) is None:
+        return None
+    return shard
+
+
+# HOURLY_KEYFRAME_EVERY=N stores hourly forecasts as deltas of the previous
+# one, see store.forecast_delta(), with a full keyframe every N forecasts.
+HOURLY_KEYFRAME_EVERY = int(os.environ.get('HOURLY_KEYFRAME_EVERY', 0))
+# prefix -> (name, generation, forecast, deltas since the keyframe)
+last_forecasts = {}
+last_forecasts_lock = threading.Lock()
+
+
+def write_forecast(prefix, filename, payload, schema=None):
+    """Write a forecast as a delta of the previous one written.
+
+    Only forecasts written by this instance are used as a base, a keyframe
+    is written after a restart. Writes are serialized so each delta is
+    based on the forecast written right before it.
+    """
+    try:
+        forecast = json.loads(payload)
+    except ValueError:
+        forecast = None
+
+    with last_forecasts_lock:
+        previous = last_forecasts.get(prefix)
+        stored = payload
+        count = 0
+        if previous is not None and previous[3] + 1 < HOURLY_KEYFRAME_EVERY:
+            delta = forecast_delta(previous[0], previous[1], previous[2], forecast)
+            if delta is not None:
+                stored = json.dumps(delta, separators=(',', ':'))
+                count = previous[3] + 1
+
+        blob = create_file(stored, filename, schema)
+        if add_to_manifest(prefix, blob, payload, schema=schema) is None:
+            return None
+        last_forecasts[prefix] = (blob.name, blob.generation, forecast, count)
+        print("Stored {} in {} bytes, {} in full.".format(
+            filename, len(stored), len(payload)))
+    return blob
+
+
+def store_payload(prefix, filename, payload):
+    # Writes a pushed payload, None when it couldn't be written. Timestamps
+    # are stored in Toronto time so readers don't convert them.
+    payload, schema = normalize_payload(payload)
+    if prefix == 'hourly' and HOURLY_KEYFRAME_EVERY and not SHARD_PERIOD:
+        return write_forecast(prefix, filename, payload, schema)
+
+    blob = write_record(prefix, filename, payload, schema)
+    if blob is not None and prefix == 'realtime':
+        realtime_index.add(filename)
+    return blob
+
+
+# WRITE_BEHIND_WORKERS=N acknowledges pushes as soon as they are queued and
+# writes them from N background threads. A queued payload only lives in
+# memory: it is lost if the instance is killed before the queue drained
+# (SIGTERM gives Cloud Run instances 10 seconds). A write failing all its
+# retries is published again to come back through Pub/Sub. The writes run
+# after the response, the service needs CPU always allocated
+# (--no-cpu-throttling) or they stall until the next request.
+WRITE_BEHIND_WORKERS = int(os.environ.get('WRITE_BEHIND_WORKERS', 0))
+WRITE_QUEUE_SIZE = int(os.environ.get('WRITE_QUEUE_SIZE', 256))
+WRITE_DRAIN_SECONDS = float(os.environ.get('WRITE_DRAIN_SECONDS', 8))
+# Seconds a worker waits for a failed write to be published again.
+REPUBLISH_TIMEOUT = 30
+writes = None
+
+
+def republish(prefix, filename, payload):
+    print("Publishing {} again.".format(filename))
+    if not pubsub(payload, prefix, timeout=REPUBLISH_TIMEOUT):
+        print("error: {} lost".format(filename))
+
+
+def drain_writes(signum=None, frame=None, previous=None):
+    if writes is not None and not writes.closed:
+        print("Draining {} queued writes.".format(writes.queue.qsize()))
+        if not writes.drain(WRITE_DRAIN_SECONDS):
+            print("error: {} writes not drained".format(writes.queue.unfinished_tasks))
+    if callable(previous):
+        previous(signum, frame)
+
+
+if WRITE_BEHIND_WORKERS:
+    writes = WriteBehind(store_payload, WRITE_BEHIND_WORKERS, WRITE_QUEUE_SIZE,
+                         failed=republish)
+    atexit.register(drain_writes)
+    try:
+        # Chained with the server's own handler (gunicorn's graceful exit).
+        signal.signal(signal.SIGTERM, partial(
+            drain_writes, previous=signal.getsignal(signal.SIGTERM)))
+    except ValueError:
+        # Not the main thread, atexit still drains.
+        pass
+
+
+def store_push(prefix, filename, payload):
+    # Response to a Pub/Sub push, a 503 has it delivered again.
+    if writes is not None:
+        if writes.submit(prefix, filename, payload):
+            return ('', 204)
+        msg = 'write queue full'
+    elif store_payload(prefix, filename, payload) is not None:
+        return ('', 204)
+    else:
+        msg = 'record not written'
+    print(f'error: {msg}')
+    return f'Service Unavailable: {msg}', 503
+
+
+# OBJECT_LAYOUT=partitioned writes new blobs under day partitions,
+# 'realtime/2020/12/23/realtime-20201223-191503'. Both layouts are read.
+OBJECT_LAYOUT = os.environ.get('OBJECT_LAYOUT', 'flat')
+if OBJECT_LAYOUT not in LAYOUTS:
+    print("Unknown OBJECT_LAYOUT {}, blobs are written flat.".format(OBJECT_LAYOUT))
+    OBJECT_LAYOUT = 'flat'
+
+
+def list_bucket(**kwargs):
+    # storage_client.list_blobs on the bucket, for store.list_range.
+    return storage_client.list_blobs(bucket, **kwargs)
 
-    blob.upload_from_string(data=payload,
-                            content_type='text/plain')
+
+def store_blobs(prefix, file_start=None, file_end=None, last=1):
+    """Blobs of a prefix for a /store/* GET, in name order.
+
+    They come from the manifest, or without one from a listing bounded to
+    the requested range or to the last blobs. Records appended to shards
+    are only in the manifest, the listing leaves them out.
+    """
+    manifest = load_manifest(prefix)
+    if manifest is not None:
+        return BucketBlobs(bucket, manifest.names, manifest.generations,
+                           manifest.segments, manifest.shards, manifest.schemas,
+                           manifest.keys)
+
+    print("No manifest for {}, listing the requested blobs.".format(prefix))
+    if file_start != None and file_end != None:
+        return listed_blobs(bucket, list_range(list_bucket, prefix,
+                                               *range_bounds(file_start, file_end)))
+    return listed_blobs(bucket, list_blob_last(list_bucket, prefix, int(last)))
 
 
 def access_secret_version(project_id, secret_id, version_id):
@@ -91,7 +353,9 @@ request_headers = {
 climacell_url_realtime = "https://api.climacell.co/v3/weather/realtime"
 climacell_url_hourly = "https://api.climacell.co/v3/weather/forecast/hourly"
 
-def pubsub(json_payload,mode_data):
+def pubsub(json_payload,mode_data, timeout=None):
+    # With a timeout, waits at most that long and returns whether the
+    # message was published.
     futures = dict()
 
     def get_callback(f, data):
@@ -119,19 +383,71 @@ def pubsub(json_payload,mode_data):
 
     print(futures.items)
 
+    if timeout is not None:
+        # A failed publish never leaves `futures`, wait on the future.
+        try:
+            future.result(timeout=timeout)
+            return True
+        except Exception as e:  # noqa
+            print("error: publish to {} failed: {!r}".format(mode_data, e))
+            return False
+
     # Wait for all the publish futures to resolve before exiting.
     while futures:
         time.sleep(1)
 
 
-def get_metric_list_from_bucket(pre):
-    blobs = list(storage_client.list_blobs(bucket, prefix=pre))
+# Largest page a /store/list/ request can ask for, GCS returns at most
+# 1000 objects per page anyway.
+LIST_PAGE_MAX = 1000
+
+
+def get_metric_list_from_bucket(pre, limit=None, page_token=None):
+    """Blob names and dates under a prefix, and the cursor of the next page.
+
+    Without limit and page_token everything is listed in time order
+    (name_key) and the cursor is None. Otherwise one GCS page is listed and
+    its page token returned, pages follow GCS name order: flat names first,
+    then the day partitions.
+    """
+    paginate = limit is not None or page_token is not None
+    blobs = storage_client.list_blobs(bucket, prefix=pre,
+                                      max_results=limit if paginate else None,
+                                      page_token=page_token)
+    next_page_token = None
+    if paginate:
+        page = next(blobs.pages, ())
+        next_page_token = blobs.next_page_token
+        blobs = page
+    else:
+        blobs = sorted(blobs, key=lambda _b: name_key(_b.name))
+
+    return metric_list(_b.name for _b in blobs), next_page_token
+
+
+def get_metric_list_from_manifest(manifest, limit=None, page_token=None):
+    """Like get_metric_list_from_bucket, from the manifest names.
+
+    Records appended to shards only exist there. The page token is the
+    offset of the next page in the manifest.
+    """
+    if limit is None and page_token is None:
+        return metric_list(manifest.names), None
+    offset = int(page_token or 0)
+    names = manifest.names[offset:offset + limit]
+    following = None
+    if offset + limit < len(manifest):
+        following = str(offset + limit)
+    return metric_list(names), following
+
+
+def metric_list(names):
     metric_list = []
-    for _b in blobs:
-        datestr = ' '.join(_b.name.rsplit('-', 2)[1:3])
+    for name in names:
+        datestr = ' '.join(name.rsplit('-', 2)[1:3])
         try:
             #dateobj = datetime.strptime(filename, "%Y%m%d %H%M%S")
-            item = {"name": _b.name, "dateobj": datestr}
+            item = {"name": name, "dateobj": datestr}
             metric_list.append(item)
         except ValueError:
             pass
@@ -139,6 +455,50 @@ def get_metric_list_from_bucket(pre):
     return metric_list
 
 
+def list_response(pre):
+    # Plain list as before, or {"items", "next_page_token"} when the
+    # request pages with limit/page_token. With start and end, only the
+    # blobs of that range are listed, day partitions concurrently. When
+    # records are appended to shards the names come from the manifest.
+    limit = request.args.get('limit', None)
+    page_token = request.args.get('page_token', None)
+    start = request.args.get('start', None)
+    end = request.args.get('end', None)
+    manifest = load_manifest(pre)
+    if manifest is not None and not (SHARD_PERIOD or manifest.shards):
+        manifest = None
+
+    if start is not None and end is not None:
+        if manifest is not None:
+            names = [manifest.names[i] for i in
+                     reversed(resolve_range(manifest.keys, start, end))]
+        else:
+            blobs = list_range(list_bucket, pre, *range_bounds(start, end))
+            names = sorted((_b.name for _b in blobs), key=name_key)
+        return json.dumps(metric_list(names))
+    if limit is None and page_token is None:
+        if manifest is not None:
+            return json.dumps(get_metric_list_from_manifest(manifest)[0])
+        return json.dumps(get_metric_list_from_bucket(pre)[0])
+
+    try:
+        limit = min(int(limit or LIST_PAGE_MAX), LIST_PAGE_MAX)
+    except ValueError:
+        msg = 'limit must be an integer'
+        print(f'error: {msg}')
+        return f'Bad Request: {msg}', 400
+    if manifest is not None and not (page_token or '0').isdigit():
+        msg = 'page_token must come from a previous page'
+        print(f'error: {msg}')
+        return f'Bad Request: {msg}', 400
+
+    if manifest is not None:
+        items, next_page_token = get_metric_list_from_manifest(manifest, limit, page_token)
+    else:
+        items, next_page_token = get_metric_list_from_bucket(pre, limit, page_token)
+    return json.dumps({"items": items, "next_page_token": next_page_token})
+
+
 @app.route('/realtime/', methods=['GET'])
 def realtime():
 
@@ -149,11 +509,14 @@ def realtime():
     print(response_realtime.status_code)
     # print(json.dumps(response_realtime.json(), indent=4, sort_keys=True))
 
-    _json = scan_and_apply_tz(response_realtime.json())
+    # scan_and_apply_tz returns a converted copy, the raw payload is
+    # still intact for the response.
+    raw = response_realtime.json()
+    _json = scan_and_apply_tz(raw)
 
     pubsub(json.dumps(_json),'realtime')
 
-    return json.dumps(response_realtime.json(), indent=4, sort_keys=True)
+    return json.dumps(raw, indent=4, sort_keys=True)
 
 
 @app.route('/hourly/', methods=['GET'])
@@ -166,85 +529,270 @@ def hourly():
     print(response_hourly.status_code)
     # print(json.dumps(response_hourly.json(), indent=4, sort_keys=True))
 
-    _json = scan_and_apply_tz(response_hourly.json())
+    # scan_and_apply_tz returns a converted copy, the raw payload is
+    # still intact for the response.
+    raw = response_hourly.json()
+    _json = scan_and_apply_tz(raw)
 
     pubsub(json.dumps(_json),'hourly')
 
-    return json.dumps(response_hourly.json(), indent=4, sort_keys=True)
+    return json.dumps(raw, indent=4, sort_keys=True)
+
+def last_range(last, count):
+    # Indexes of the `last` newest of `count` blobs. Clamped, a streamed
+    # response can't fail on a missing blob once it has started.
+    last = min(int(last), count)
+    return range(-1, -last - 1, -1)
+
+def realtime_names_after(newest):
+    # Realtime blob names after `newest`, all of them when it's None.
+    manifest = load_manifest('realtime')
+    if manifest is None:
+        lo = name_stamp(newest) if newest is not None else None
+        return [_b.name for _b in list_range(list_bucket, 'realtime', lo)]
+    if newest is None:
+        return manifest.names
+    return manifest.after(newest)
+
+
+def refresh_realtime_index():
+    # Adds what was written since the last refresh, everything the first time.
+    with realtime_index_lock:
+        realtime_index.refresh(realtime_names_after)
+
+
+def slot_blobs(slot, slot_end):
+    refresh_realtime_index()
+    names = realtime_index.range(parse_datetime(slot), parse_datetime(slot_end))
+    names = names[::-1]
+
+    # Generations and schemas from the manifest, so these reads can be
+    # cached too.
+    manifest = manifests.get('realtime', (None,))[0]
+    if manifest is None:
+        return BucketBlobs(bucket, names)
+
+    generations = []
+    schemas = []
+    for name in names:
+        i = manifest.index(name)
+        generations.append(manifest.generations[i] if i is not None else None)
+        schemas.append(manifest.schemas[i] if i is not None else None)
+    return BucketBlobs(bucket, names, generations, manifest.segments,
+                       manifest.shards, schemas)
+
+
+def stream_records(last, blobs):
+    """Streamed response of the records, written as the blobs download.
+
+    A JSON array by default, NDJSON with ?format=ndjson or when the client
+    only accepts application/x-ndjson. ?fields=temp,humidity projects the
+    records on those fields.
+    """
+    fields = parse_fields(request.args.get('fields', None))
+    latencies = []
+    records = logged_records(
+        iter_last_json(last, blobs, latencies=latencies, fields=fields),
+        latencies)
 
-def last_range(last):
-    if last != 1:
-        last = range(-1, 0 - int(last) - 1, -1)
-    else:
-        last = range(-1, -2, -1)
-
-    return last
-
-def last_json(last,blobs):
-    last_json = []
-    for i in last:
-        j = json.loads(blobs[i].download_as_string())
-        j = scan_and_apply_tz(j)
-        if isinstance(j, list):
-            # For hourly forecast, one blob contain several days
-            # We need to split them in order to replicate the
-            # same structure we have with realtime.
-            for item in j:
-                item['name'] = blobs[i].name
-                last_json.append(item)
-        else:
-            # For realtime data, one day is already in a single object
-            j['name'] = blobs[i].name
-            last_json.append(j)
-    return last_json
+    if (request.args.get('format') == 'ndjson' or
+            request.accept_mimetypes.best == 'application/x-ndjson'):
+        return Response(stream_with_context(iter_ndjson(records)),
+                        mimetype='application/x-ndjson')
+    return Response(stream_with_context(iter_json_array(records)),
+                    mimetype='application/json')
 
-def range_start_end(blobs, file_start, file_end):
-    x_start = None
-    x_end = None
 
-    x = -1
-    reverse = blobs[::-1]
-    for _b in reverse:
-        if _b.name == file_start:
-            x_start = x
-        if _b.name == file_end:
-            x_end = x
+@app.route('/store/realtime/', methods=['GET'])
+def store_realtime_get():
+    last = request.args.get('last', 1)
+    file_start = request.args.get('start', None)
+    file_end = request.args.get('end', None)
+    slot = request.args.get('slot', None)
+    slot_end = request.args.get('slot_end', slot)
 
-        x = x - 1
+    if slot != None:
+        print("Get slots {} to {}.".format(slot, slot_end))
+        blobs = slot_blobs(slot, slot_end)
+        return stream_records(range(len(blobs)), blobs)
 
-        if x_start != None and x_end != None:
-            break
+    blobs = store_blobs('realtime', file_start, file_end, last)
+    if file_start != None and file_end != None:
+        print("Get from {} to {}.".format(file_start,file_end))
+        last = resolve_range(blobs.keys, file_start, file_end)
 
-    if x_start == x_end:
-        x_end = x_end - 1
+    else:
+        last = last_range(last, len(blobs))
 
-    last = range(x_start, x_end, -1)
+    return stream_records(last, blobs)
 
-    return last
 
+@app.route('/store/realtime/aggregate', methods=['GET'])
+def store_realtime_aggregate():
+    """Downsampled realtime series, e.g. hourly mean temperature.
+
+    ?bucket=1h|1d, ?agg=mean|min|max|sum|last, ?fields=temp,humidity and
+    the same last/start/end selection as /store/realtime/. Only the numeric
+    values are returned, one per bucket and field.
+    """
+    bucket_size = request.args.get('bucket', '1h')
+    agg = request.args.get('agg', 'mean')
+    fields = parse_fields(request.args.get('fields', None))
+    if bucket_size not in BUCKETS or agg not in AGGREGATES:
+        msg = 'bucket must be one of {} and agg one of {}'.format(
+            '|'.join(BUCKETS), '|'.join(AGGREGATES))
+        print(f'error: {msg}')
+        return f'Bad Request: {msg}', 400
 
-@app.route('/store/realtime/', methods=['GET'])
-def store_realtime_get():
     last = request.args.get('last', 1)
     file_start = request.args.get('start', None)
     file_end = request.args.get('end', None)
-
-    blobs = list(storage_client.list_blobs(bucket, prefix='realtime'))
+    blobs = store_blobs('realtime', file_start, file_end, last)
     if file_start != None and file_end != None:
-        print("Get from {} to {}.".format(file_start,file_end))
-        last = range_start_end(blobs, file_start, file_end)
-
+        last = resolve_range(blobs.keys, file_start, file_end)
     else:
-        last = last_range(last)
+        last = last_range(last, len(blobs))
+
+    read = None
+    if fields is not None:
+        read = fields | {'observation_time'}
+    latencies = []
+    records = list(logged_records(
+        iter_last_json(last, blobs, latencies=latencies, fields=read), latencies))
+    result = aggregate_records(records, fields, bucket_size, agg)
+    print("Aggregated {} records in {} buckets.".format(len(records), len(result["time"])))
+    return Response(json.dumps(result), mimetype='application/json')
+
+
+@app.route('/store/compact/realtime/', methods=['POST'])
+def store_compact_realtime():
+    """Roll a closed UTC day of realtime blobs into one columnar segment.
+
+    Meant to be called daily (Cloud Scheduler), ?day=YYYYMMDD defaults to
+    yesterday. Reads of that day then download the segment instead of
+    every blob; the raw blobs are kept.
+    """
+    today = datetime.utcnow().strftime("%Y%m%d")
+    day = request.args.get('day', (datetime.utcnow() - timedelta(days=1)).strftime("%Y%m%d"))
+    if len(day) != 8 or not day.isdigit() or day >= today:
+        msg = 'day must be a closed day, YYYYMMDD'
+        print(f'error: {msg}')
+        return f'Bad Request: {msg}', 400
 
-    _json = last_json(last,blobs)
-    return json.dumps(_json)
+    manifest = load_manifest('realtime')
+    if manifest is None:
+        msg = 'no manifest for realtime'
+        print(f'error: {msg}')
+        return f'Conflict: {msg}', 409
+
+    names = manifest.day_names(day)
+    records = read_raw_records(BucketBlobs(bucket, names, shards=manifest.shards))
+    # Stored normalized, the segment reads need no conversion.
+    data = dumps_segment([scan_and_apply_tz(r) for r in records], TZ_SCHEMA)
+
+    blob = bucket.blob(segment_name('realtime', day))
+    blob.upload_from_string(data=data, content_type='application/octet-stream')
+    if update_manifest(bucket, 'realtime',
+                       lambda m: m.add_segment(day, blob.name, blob.generation),
+                       blob.name, rebuild_manifest) is None:
+        msg = 'segment not recorded, call again'
+        print(f'error: {msg}')
+        return f'Service Unavailable: {msg}', 503
+
+    print("Compacted {} blobs of {} in {} bytes.".format(len(names), day, len(data)))
+    return json.dumps({"day": day, "blobs": len(names), "bytes": len(data)})
+
+
+# Blobs rewritten per /store/migrate/tz/ call, a call has to fit in the
+# request timeout.
+MIGRATE_BATCH = 200
+
+
+def migrate_blob(_b):
+    # Rewrites a listed blob with its timestamps in Toronto time, in the
+    # same codec. Returns the blob as now stored, the listed one when it was
+    # already normalized, None when it can't be or changed meanwhile.
+    metadata = _b.metadata or {}
+    if metadata.get('schema') == TZ_SCHEMA:
+        return _b
+
+    try:
+        data = _b.download_as_string(if_generation_match=_b.generation)
+        payload, schema = normalize_payload(decompress(data).decode('utf-8'))
+        if schema is None:
+            return None
+        blob = bucket.blob(_b.name)
+        blob.metadata = dict(metadata, schema=schema)
+        blob.upload_from_string(
+            data=compress(payload.encode('utf-8'), sniff_codec(data)),
+            content_type=_b.content_type,
+            if_generation_match=_b.generation)
+        return blob
+    except PreconditionFailed:
+        print("{} changed, left for the next run.".format(_b.name))
+        return None
+
+
+@app.route('/store/migrate/tz/', methods=['POST'])
+def store_migrate_tz():
+    """Rewrite the blobs of a prefix written before timestamps were
+    normalized on write.
+
+    ?prefix=realtime|hourly, ?start=<blob name> resumes where the previous
+    call stopped and ?limit= caps the blobs listed per call. Returns the
+    next start, null once the prefix is done. Normalized blobs are skipped
+    but their generation is still recorded, calling it again is harmless and
+    repairs the manifest after a failed update (503).
+    """
+    prefix = request.args.get('prefix', 'realtime')
+    if prefix not in ('realtime', 'hourly'):
+        msg = 'prefix must be realtime or hourly'
+        print(f'error: {msg}')
+        return f'Bad Request: {msg}', 400
+    start = request.args.get('start', None)
+    limit = min(int(request.args.get('limit', MIGRATE_BATCH)), LIST_PAGE_MAX)
+
+    blobs = list(storage_client.list_blobs(bucket, prefix=prefix, start_offset=start,
+                                           max_results=limit + 1))
+    following = blobs[limit].name if len(blobs) > limit else None
+    migrated = 0
+    stored = {}
+    for _b in blobs[:limit]:
+        blob = migrate_blob(_b)
+        if blob is None:
+            continue
+        if blob is not _b:
+            migrated += 1
+        stored[blob.name] = blob.generation
+
+    # Generations the manifest doesn't have yet, including blobs migrated
+    # by an earlier call whose manifest update failed.
+    manifest = load_manifest(prefix)
+    if manifest is not None:
+        for name in list(stored):
+            i = manifest.index(name)
+            if (i is not None and manifest.generations[i] == stored[name] and
+                    manifest.schemas[i] == TZ_SCHEMA):
+                del stored[name]
+
+    def update(manifest):
+        for name, generation in stored.items():
+            manifest.add(name, generation=generation, schema=TZ_SCHEMA)
+
+    if stored and manifest is not None and update_manifest(
+            bucket, prefix, update, "{} migrated blobs".format(len(stored)),
+            rebuild_manifest) is None:
+        msg = 'manifest not updated, call again with the same start'
+        print(f'error: {msg}')
+        return f'Service Unavailable: {msg}', 503
+
+    print("Migrated {} of {} {} blobs.".format(migrated, len(blobs[:limit]), prefix))
+    return json.dumps({"prefix": prefix, "migrated": migrated, "next": following})
 
 
 @app.route('/store/list/realtime/', methods=['GET'])
 def store_list_realtime_get():
-    realtime_list = get_metric_list_from_bucket("realtime")
-    return json.dumps(realtime_list)
+    return list_response("realtime")
 
 
 @app.route('/store/realtime/', methods=['POST'])
@@ -266,10 +814,8 @@ def store_realtime():
     if isinstance(pubsub_message, dict) and 'data' in pubsub_message:
         payload = base64.b64decode(pubsub_message['data']).decode('utf-8').strip()
 
-    filename = "realtime-" + datetime.now().strftime("%Y%m%d-%H%M%S")
-    create_file(payload, filename)
-
-    return ('', 204)
+    filename = stamp_name('realtime', datetime.now(), OBJECT_LAYOUT)
+    return store_push('realtime', filename, payload)
 
 
 @app.route('/store/hourly/', methods=['GET'])
@@ -278,22 +824,20 @@ def store_hourly_get():
     file_end = request.args.get('end', None)
     last = request.args.get('last', 1)
 
-    blobs = list(storage_client.list_blobs(bucket, prefix='hourly'))
+    blobs = store_blobs('hourly', file_start, file_end, last)
     if file_start != None and file_end != None:
         print("Get from {} to {}.".format(file_start, file_end))
-        last = range_start_end(blobs, file_start, file_end)
+        last = resolve_range(blobs.keys, file_start, file_end)
     else:
-        last = last_range(last)
+        last = last_range(last, len(blobs))
 
 
-    _json = last_json(last, blobs)
-    return json.dumps(_json)
+    return stream_records(last, blobs)
 
 
 @app.route('/store/list/hourly/', methods=['GET'])
 def store_list_hourly_get():
-    hourly_list = get_metric_list_from_bucket("hourly")
-    return json.dumps(hourly_list)
+    return list_response("hourly")
 
 
 @app.route('/store/hourly/', methods=['POST'])
@@ -316,10 +860,23 @@ def store_hourly():
         payload = base64.b64decode(
             pubsub_message['data']).decode('utf-8').strip()
 
-    filename = "hourly-" + datetime.now().strftime("%Y%m%d-%H%M%S")
-    create_file(payload, filename)
+    filename = stamp_name('hourly', datetime.now(), OBJECT_LAYOUT)
+    return store_push('hourly', filename, payload)
+
+
+@app.route('/store/cache/', methods=['GET'])
+def store_cache_get():
+    stats = blob_cache.stats()
+    stats["timestamps"] = timestamp_cache_info()._asdict()
+    return json.dumps(stats)
+
 
-    return ('', 204)
+@app.route('/store/writes/', methods=['GET'])
+def store_writes_get():
+    # Queue depth and write latencies of the write-behind mode.
+    if writes is None:
+        return json.dumps({"write_behind": False})
+    return json.dumps(dict(writes.stats(), write_behind=True))
 
 
 def has_no_empty_params(rule):
@@ -0,0 +1,259 @@
+import io
+import json
+
+import numpy as np
+
+from yadt import toronto_offsets
+
+# Columns of a segment are the record paths joined with SEPARATOR, e.g.
+# 'temp.value', 'temp.units', 'lat', 'name'.
+SEPARATOR = '.'
+META = '__meta__'
+PRESENT = '__present__'
+INTS = '__ints__'
+
+
+class _Missing:
+    pass
+
+
+_MISSING = _Missing()
+
+
+def flatten(record, prefix=()):
+    # (path, value) pairs of the leaves of a record, in record order.
+    stack = [(prefix, record)]
+    leaves = []
+    while stack:
+        path, node = stack.pop()
+        if isinstance(node, dict) and (node or not path):
+            stack.extend((path + (k,), v) for k, v in reversed(list(node.items())))
+        else:
+            leaves.append((path, node))
+    return leaves
+
+
+def _kind(values):
+    kinds = set()
+    for v in values:
+        if v is None:
+            continue
+        if isinstance(v, bool) or isinstance(v, (dict, list)):
+            return 'json'
+        if isinstance(v, int):
+            kinds.add('int')
+        elif isinstance(v, float):
+            kinds.add('float')
+        elif isinstance(v, str):
+            kinds.add('str')
+        else:
+            return 'json'
+    if kinds <= {'int'}:
+        return 'int'
+    if kinds <= {'int', 'float'}:
+        return 'float'
+    if kinds == {'str'}:
+        return 'str'
+    return 'json'
+
+
+def records_to_columns(records):
+    """One numpy array per record path, plus the metadata to rebuild them.
+
+    Numbers are stored as float64 (ints mixed with floats are flagged so
+    they come back as ints), strings as unicode arrays, anything else as
+    JSON text. A path missing from a
+    record or holding None is marked absent/null in a mask.
+    """
+    order = []
+    seen = set()
+    values = {}
+    for row, record in enumerate(records):
+        for path, value in flatten(record):
+            key = SEPARATOR.join(path)
+            if key not in seen:
+                seen.add(key)
+                order.append(key)
+                values[key] = [_MISSING] * len(records)
+            values[key][row] = value
+
+    columns = {}
+    meta = {"version": 1, "rows": len(records), "order": order, "kinds": {}}
+    for key in order:
+        column = values[key]
+        present = [v is not _MISSING for v in column]
+        column = [None if v is _MISSING else v for v in column]
+        kind = _kind(column)
+        meta["kinds"][key] = kind
+
+        if kind in ('int', 'float'):
+            data = np.array([np.nan if v is None else v for v in column], dtype='float64')
+            ints = [isinstance(v, int) for v in column]
+            if kind == 'float' and any(ints):
+                columns[INTS + key] = np.array(ints, dtype='bool')
+        elif kind == 'str':
+            data = np.array(['' if v is None else v for v in column], dtype='U')
+        else:
+            data = np.array([json.dumps(v) for v in column], dtype='U')
+        columns[key] = data
+
+        nulls = [v is None for v in column]
+        if not all(present) or (kind == 'str' and any(nulls)):
+            # 0: absent, 1: null, 2: value
+            columns[PRESENT + key] = np.array(
+                [(2 if v is not None else 1) if p else 0 for p, v in zip(present, column)],
+                dtype='int8')
+
+    meta["masks"] = [k for k in columns if k.startswith((PRESENT, INTS))]
+    return columns, meta
+
+
+def _value(kind, data, i, ints=None):
+    if kind == 'int' or kind == 'float':
+        v = data[i]
+        if np.isnan(v):
+            return None
+        if kind == 'int' or (ints is not None and ints[i]):
+            return int(v)
+        return float(v)
+    if kind == 'str':
+        return str(data[i])
+    return json.loads(str(data[i]))
+
+
+def columns_to_records(columns, meta, rows=None, fields=None):
+    """Rebuild the records (or the given rows) from their columns.
+
+    `columns` is a mapping, an NpzFile only loads the columns actually
+    accessed. With `fields`, only the paths under those top level keys
+    are read.
+    """
+    if rows is None:
+        rows = range(meta["rows"])
+    keys = meta["order"]
+    if fields is not None:
+        keys = [k for k in keys if k.split(SEPARATOR, 1)[0] in fields]
+
+    records = [{} for _ in rows]
+    for key in keys:
+        kind = meta["kinds"][key]
+        data = columns[key]
+        mask = columns[PRESENT + key] if PRESENT + key in meta["masks"] else None
+        ints = columns[INTS + key] if INTS + key in meta["masks"] else None
+        path = key.split(SEPARATOR)
+        for record, i in zip(records, rows):
+            if mask is not None:
+                if mask[i] == 0:
+                    continue
+                value = None if mask[i] == 1 else _value(kind, data, i, ints)
+            else:
+                value = _value(kind, data, i, ints)
+
+            node = record
+            for k in path[:-1]:
+                node = node.setdefault(k, {})
+            node[path[-1]] = value
+
+    return records
+
+
+def dumps_segment(records, schema=None):
+    # `schema` is kept in the metadata, see store.TZ_SCHEMA.
+    columns, meta = records_to_columns(records)
+    if schema is not None:
+        meta["schema"] = schema
+    out = io.BytesIO()
+    np.savez_compressed(out, **{META: np.array(json.dumps(meta))}, **columns)
+    return out.getvalue()
+
+
+class _Columns(dict):
+    # Columns of an NpzFile, each one decompressed on first access only.
+    def __init__(self, npz):
+        super().__init__()
+        self.npz = npz
+
+    def __missing__(self, key):
+        value = self[key] = self.npz[key]
+        return value
+
+
+class Segment:
+    """A compacted day of records, read column by column.
+
+    Records are looked up by their 'name' column.
+    """
+
+    def __init__(self, data):
+        self.npz = np.load(io.BytesIO(data), allow_pickle=False)
+        self.columns = _Columns(self.npz)
+        self.meta = json.loads(str(self.npz[META]))
+        self.rows = {}
+        if 'name' in self.meta["kinds"]:
+            self.rows = {str(name): i for i, name in enumerate(self.columns['name'])}
+
+    def __len__(self):
+        return self.meta["rows"]
+
+    def records(self, names=None, fields=None):
+        # Records of the given names (all of them by default), None for the
+        # names this segment doesn't hold.
+        if names is None:
+            return columns_to_records(self.columns, self.meta, fields=fields)
+        rows = [self.rows.get(name) for name in names]
+        found = columns_to_records(self.columns, self.meta,
+                                   [i for i in rows if i is not None], fields)
+        found = iter(found)
+        return [None if i is None else next(found) for i in rows]
+
+
+# Downsampling of numeric series. Hourly buckets are UTC hours (Toronto
+# offsets are whole hours, so they are Toronto hours too, without the
+# fall back hour merged twice), daily buckets are Toronto days.
+BUCKETS = {'1h': 3600, '1d': 86400}
+AGGREGATES = ('mean', 'min', 'max', 'sum', 'last')
+
+
+def bucket_keys(seconds, bucket):
+    # Start of the bucket of each UTC epoch second: UTC seconds for '1h',
+    # Toronto wall-clock seconds of midnight for '1d'.
+    step = BUCKETS[bucket]
+    if bucket == '1d':
+        seconds = seconds + toronto_offsets(seconds)
+    return seconds // step * step
+
+
+def aggregate(seconds, series, bucket='1h', agg='mean'):
+    """Downsample float64 series (NaN for missing) sampled at UTC seconds.
+
+    Returns the bucket keys (see bucket_keys()) and one array per series,
+    NaN for a bucket without any value.
+    """
+    seconds = np.asarray(seconds, dtype='int64')
+    order = np.argsort(seconds, kind='stable')
+    keys = bucket_keys(seconds[order], bucket)
+    if not len(keys):
+        return keys, {name: np.array([], dtype='float64') for name in series}
+
+    starts = np.flatnonzero(np.diff(keys)) + 1
+    starts = np.concatenate(([0], starts))
+    out = {}
+    for name, values in series.items():
+        values = np.asarray(values, dtype='float64')[order]
+        valid = ~np.isnan(values)
+        counts = np.add.reduceat(valid.astype('int64'), starts)
+        if agg == 'min':
+            result = np.fmin.reduceat(values, starts)
+        elif agg == 'max':
+            result = np.fmax.reduceat(values, starts)
+        elif agg == 'last':
+            idx = np.where(valid, np.arange(len(values)), -1)
+            idx = np.maximum.reduceat(idx, starts)
+            result = values[np.maximum(idx, 0)]
+        else:
+            result = np.add.reduceat(np.where(valid, values, 0.0), starts)
+            if agg == 'mean':
+                result = result / np.maximum(counts, 1)
+        out[name] = np.where(counts > 0, result, np.nan)
+
+    return keys[starts], out
@@ -0,0 +1,75 @@
+'''
+pip install -U pytest
+
+> pytest
+'''
+
+import copy
+from datetime import datetime
+import json
+
+import numpy as np
+
+from columnar import dumps_segment, records_to_columns, columns_to_records, Segment, \
+    aggregate
+from yadt_test import lst
+
+
+def test_columns_round_trip():
+    records = copy.deepcopy(lst)
+    records[1].pop("sunrise")
+    records[2]["weather_code"]["value"] = None
+    records[0]["extra"] = {"value": [1, 2]}
+
+    columns, meta = records_to_columns(records)
+
+    assert columns["temp.value"].dtype == 'float64'
+    assert meta["kinds"]["visibility.value"] == 'int'
+    assert columns_to_records(columns, meta) == records
+    assert json.dumps(columns_to_records(columns, meta)) == json.dumps(records)
+
+
+def test_segment_lookup_by_name():
+    segment = Segment(dumps_segment(lst))
+
+    records = segment.records(["realtime-20201223-181503", "realtime-20201224-000000"])
+
+    assert len(segment) == len(lst)
+    assert records == [lst[1], None]
+
+
+def test_segment_fields():
+    segment = Segment(dumps_segment(lst))
+
+    records = segment.records(fields={"temp", "name"})
+
+    assert records[0] == {"temp": lst[0]["temp"], "name": lst[0]["name"]}
+
+
+def test_aggregate_hourly():
+    # 15 minute samples over three UTC hours, one of them missing a value.
+    seconds = 1608750000 + 900 * np.arange(12)
+    temp = np.arange(12, dtype='float64')
+    temp[5] = np.nan
+
+    expected = {
+        'mean': [1.5, (4 + 6 + 7) / 3, 9.5],
+        'min': [0, 4, 8],
+        'max': [3, 7, 11],
+        'sum': [6, 17, 38],
+        'last': [3, 7, 11],
+    }
+    for agg, values in expected.items():
+        keys, out = aggregate(seconds[::-1], {'temp': temp[::-1]}, '1h', agg)
+        assert keys.tolist() == [1608750000, 1608753600, 1608757200]
+        assert out['temp'].tolist() == values
+
+
+def test_aggregate_daily_toronto_days():
+    # 2020-12-24 03:00 and 06:00 UTC are on the 23rd and the 24th in Toronto.
+    seconds = np.array([1608778800, 1608789600])
+    keys, out = aggregate(seconds, {'temp': [1.0, np.nan]}, '1d', 'last')
+
+    assert [str(datetime.utcfromtimestamp(int(k)).date()) for k in keys] == \
+        ['2020-12-23', '2020-12-24']
+    assert out['temp'][0] == 1.0 and np.isnan(out['temp'][1])
@@ -0,0 +1,1412 @@
+from bisect import bisect_left, bisect_right, insort
+import codecs
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from functools import partial
+import gzip
+from itertools import chain
+import json
+import os
+import queue
+import threading
+import time
+from urllib.parse import quote, unquote
+import zlib
+
+from dateutil.parser import parse
+from google.api_core.exceptions import PreconditionFailed
+import numpy as np
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from columnar import Segment, aggregate
+from yadt import TZ_FIELDS, tz_object_hook, ceil_dt, utc_to_toronto, parse_iso, tz, tz_utc, \
+    scan_and_apply_tz
+
+# Bytes fetched per request when streaming a blob.
+READ_CHUNK_SIZE = 256 * 1024
+
+# Blobs downloaded at the same time by one last_json call.
+DOWNLOAD_CONCURRENCY = int(os.environ.get('DOWNLOAD_CONCURRENCY', 8))
+
+_decoder = json.JSONDecoder()
+_WHITESPACE = ' \t\n\r'
+
+
+def iter_json_records(chunks, object_hook=None):
+    """Incrementally decode a JSON document from an iterable of byte chunks.
+
+    A top level array is yielded element by element as soon as each one is
+    complete, the decoder itself only holds the record being decoded. Any
+    other document is yielded as a single record.
+    """
+    decoder = json.JSONDecoder(object_hook=object_hook) if object_hook else _decoder
+    text = codecs.getincrementaldecoder('utf-8')()
+    chunks = iter(chunks)
+    buf = ''
+    pos = 0
+    eof = False
+    array = None
+
+    def more():
+        nonlocal buf, pos, eof
+        try:
+            chunk = next(chunks)
+        except StopIteration:
+            eof = True
+            buf = buf[pos:] + text.decode(b'', final=True)
+        else:
+            buf = buf[pos:] + text.decode(chunk)
+        pos = 0
+
+    while True:
+        while pos < len(buf) and buf[pos] in _WHITESPACE:
+            pos += 1
+        if pos == len(buf):
+            if eof:
+                break
+            more()
+            continue
+
+        if array is None:
+            array = buf[pos] == '['
+            if not array:
+                # Not an array, the whole document is one record.
+                while not eof:
+                    more()
+                yield decoder.decode(buf)
+                return
+            pos += 1
+            continue
+
+        if buf[pos] == ']':
+            return
+        if buf[pos] == ',':
+            pos += 1
+            continue
+
+        try:
+            record, end = decoder.raw_decode(buf, pos)
+        except json.JSONDecodeError:
+            if eof:
+                raise
+            more()
+            continue
+        if end == len(buf) and not eof:
+            # A scalar could still be cut at the chunk boundary.
+            more()
+            continue
+
+        pos = end
+        yield record
+
+    if array:
+        raise json.JSONDecodeError('Unterminated array', buf, pos)
+
+
+class BlobCache:
+    """Converted records of stored blobs, keyed by blob name and generation.
+
+    Stored blobs are written once, so a (name, generation) pair always
+    holds the same records. The memory tier is an LRU bounded by the raw
+    blob size, the optional disk tier keeps the records as JSON files in
+    `directory` and is bounded the same way.
+    """
+
+    def __init__(self, max_bytes, directory=None, max_disk_bytes=0):
+        self.max_bytes = max_bytes
+        self.directory = directory
+        self.max_disk_bytes = max_disk_bytes
+        self.memory = OrderedDict()  # key -> (records, size)
+        self.memory_bytes = 0
+        self.disk = OrderedDict()  # key -> (path, size)
+        self.disk_bytes = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+            entries = []
+            for filename in os.listdir(directory):
+                path = os.path.join(directory, filename)
+                name, _, generation = filename[:-len('.json')].rpartition('.')
+                if filename.endswith('.json') and name:
+                    name = unquote(name)
+                    st = os.stat(path)
+                    entries.append((st.st_mtime, (name, generation), path, st.st_size))
+            for _, key, path, size in sorted(entries):
+                self.disk[key] = (path, size)
+                self.disk_bytes += size
+
+    @staticmethod
+    def _key(name, generation):
+        return (name, str(generation))
+
+    def get(self, name, generation):
+        # A copy of the cached records, None on a miss.
+        if generation is None:
+            return None
+        key = self._key(name, generation)
+
+        with self.lock:
+            entry = self.memory.get(key)
+            if entry is not None:
+                self.memory.move_to_end(key)
+                self.hits += 1
+                return [dict(record) for record in entry[0]]
+            on_disk = self.disk.get(key)
+            if on_disk is None:
+                self.misses += 1
+                return None
+            self.disk.move_to_end(key)
+
+        try:
+            with open(on_disk[0]) as f:
+                records = json.load(f)
+        except (OSError, ValueError):
+            with self.lock:
+                self.misses += 1
+            return None
+
+        with self.lock:
+            self.disk_hits += 1
+        self._put_memory(key, records, on_disk[1])
+        return [dict(record) for record in records]
+
+    def put(self, name, generation, records, size):
+        if generation is None:
+            return
+        key = self._key(name, generation)
+        records = [dict(record) for record in records]
+        self._put_memory(key, records, size)
+
+        if self.directory and size <= self.max_disk_bytes:
+            path = os.path.join(self.directory, "{}.{}.json".format(
+                quote(key[0], safe=''), key[1]))
+            tmp = "{}.{}.tmp".format(path, threading.get_ident())
+            with open(tmp, 'w') as f:
+                json.dump(records, f)
+            os.replace(tmp, path)
+            with self.lock:
+                if key not in self.disk:
+                    self.disk[key] = (path, size)
+                    self.disk_bytes += size
+                while self.disk_bytes > self.max_disk_bytes:
+                    _, (old_path, old_size) = self.disk.popitem(last=False)
+                    self.disk_bytes -= old_size
+                    try:
+                        os.remove(old_path)
+                    except OSError:
+                        pass
+
+    def _put_memory(self, key, records, size):
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.memory:
+                return
+            self.memory[key] = (records, size)
+            self.memory_bytes += size
+            while self.memory_bytes > self.max_bytes:
+                _, (_, old_size) = self.memory.popitem(last=False)
+                self.memory_bytes -= old_size
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.disk_hits + self.misses
+            return {
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": (self.hits + self.disk_hits) / lookups if lookups else None,
+                "entries": len(self.memory),
+                "bytes": self.memory_bytes,
+                "disk_entries": len(self.disk),
+                "disk_bytes": self.disk_bytes,
+            }
+
+
+blob_cache = BlobCache(
+    int(os.environ.get('BLOB_CACHE_BYTES', 64 * 1024 * 1024)),
+    os.environ.get('BLOB_CACHE_DIR'),
+    int(os.environ.get('BLOB_CACHE_DISK_BYTES', 1024 * 1024 * 1024)))
+
+
+def project(record, fields):
+    # Only the requested top level keys of a record, delta documents are
+    # kept whole to be resolved.
+    if fields is None or not isinstance(record, dict) or DELTA_KEY in record:
+        return record
+    return {k: v for k, v in record.items() if k in fields}
+
+
+# Blobs may be stored compressed (BLOB_CODEC on write). The codec is
+# sniffed from the first bytes on read, so plain, gzip and zstd blobs
+# can sit side by side.
+CODECS = ('gzip', 'zstd')
+GZIP_MAGIC = b'\x1f\x8b'
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+
+
+def compress(data, codec):
+    if codec == 'gzip':
+        return gzip.compress(data, mtime=0)
+    if codec == 'zstd':
+        return zstandard.ZstdCompressor().compress(data)
+    return data
+
+
+def sniff_codec(head):
+    # Codec of a blob from its first bytes, None when not compressed.
+    if head.startswith(GZIP_MAGIC):
+        return 'gzip'
+    if head.startswith(ZSTD_MAGIC):
+        return 'zstd'
+    return None
+
+
+def _decompressor(head):
+    codec = sniff_codec(head)
+    if codec == 'gzip':
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+    if codec == 'zstd':
+        if zstandard is None:
+            raise ValueError('zstd compressed blob, zstandard is not installed')
+        return zstandard.ZstdDecompressor().decompressobj()
+    return None
+
+
+def decompress_chunks(chunks):
+    # Byte chunks of a blob, decompressed on the fly when compressed.
+    chunks = iter(chunks)
+    head = b''
+    for chunk in chunks:
+        head += chunk
+        if len(head) >= len(ZSTD_MAGIC):
+            break
+
+    decompressor = _decompressor(head)
+    if decompressor is None:
+        if head:
+            yield head
+        yield from chunks
+        return
+
+    for chunk in chain([head], chunks):
+        data = decompressor.decompress(chunk)
+        if data:
+            yield data
+    data = decompressor.flush()
+    if data:
+        yield data
+
+
+def decompress(data):
+    return b''.join(decompress_chunks([data]))
+
+
+# Blobs written with their timestamps already in Toronto time carry this
+# schema version in their metadata ({"schema": "2"}), readers skip the
+# conversion for them. Converting twice gives the same result, so a blob
+# without the marker is simply converted on read.
+TZ_SCHEMA = '2'
+
+
+def normalize_payload(payload):
+    # A payload with its timestamps in Toronto time and its schema, the
+    # payload unchanged and None when it isn't JSON.
+    try:
+        j = json.loads(payload)
+    except ValueError:
+        return payload, None
+    return json.dumps(scan_and_apply_tz(j)), TZ_SCHEMA
+
+
+def is_normalized(blob):
+    metadata = getattr(blob, 'metadata', None) or {}
+    return metadata.get('schema') == TZ_SCHEMA
+
+
+def iter_blob_records(blob, chunk_size=READ_CHUNK_SIZE, sizes=None, fields=None):
+    # Streams a stored blob, timestamps are converted to Toronto time while
+    # the records are decoded. The size of each decompressed chunk is
+    # appended to `sizes` when given. With `fields`, records are projected
+    # and only the timestamps among those fields are converted. Normalized
+    # blobs are decoded as they are.
+    hook = tz_object_hook
+    if is_normalized(blob):
+        hook = None
+    elif fields is not None:
+        hook = partial(tz_object_hook, fields=TZ_FIELDS.intersection(fields))
+
+    with blob.open('rb', chunk_size=chunk_size) as f:
+        chunks = decompress_chunks(iter(lambda: f.read(chunk_size), b''))
+        if sizes is not None:
+            chunks = (sizes.append(len(c)) or c for c in chunks)
+        for record in iter_json_records(chunks, object_hook=hook):
+            yield project(record, fields)
+
+
+def _read_records(blob, cache, fields=None):
+    # Records of a blob as stored, from the cache when it has them. A
+    # delta forecast is returned as its single delta document. Blobs are
+    # read whole on purpose: the records are cached as a list and a delta
+    # is applied to all of its base.
+    generation = getattr(blob, 'generation', None)
+    records = cache.get(blob.name, generation)
+    if records is not None and fields is not None:
+        records = [project(record, fields) for record in records]
+    if records is None and fields is not None:
+        records = list(iter_blob_records(blob, fields=fields))
+    if records is None:
+        sizes = []
+        records = list(iter_blob_records(blob, sizes=sizes))
+        if not is_delta(records):
+            # The generation of an unpinned blob is known once read.
+            cache.put(blob.name, getattr(blob, 'generation', None), records,
+                      sum(sizes))
+    return records
+
+
+def resolve_deltas(blob, records, cache):
+    # Follows the bases of a delta forecast back to a full one, or to one
+    # already rebuilt, then applies the deltas forward. Every forecast
+    # rebuilt on the way is cached under its own blob, the next delta of
+    # the chain then starts from it.
+    chain = []
+    base = blob
+    generation = getattr(blob, 'generation', None)
+    while is_delta(records):
+        chain.append((base.name, generation, records[0]))
+        # The base generation is only used for the cache, the base is read
+        # live as a migration may have rewritten it since.
+        generation = records[0].get("base_generation")
+        base = base.bucket.blob(records[0]["base"])
+        records = cache.get(base.name, generation)
+        if records is None:
+            records = _read_records(base, cache)
+
+    for name, generation, delta in reversed(chain):
+        records = apply_delta(records, delta)
+        cache.put(name, generation, records, len(json.dumps(records)))
+    return records
+
+
+def read_blob(blob, cache=None, fields=None):
+    """All the records of a blob and how long it took to get them.
+
+    Blobs with a known generation go through the cache. Only full reads
+    are cached, a projected read uses the cache but doesn't fill it.
+    Delta forecasts are rebuilt from their keyframe. The records are
+    decoded incrementally but returned as a list, a blob is held whole
+    in memory once read.
+    """
+    begin = time.perf_counter()
+    cache = cache or blob_cache
+
+    records = None
+    if isinstance(blob, SegmentRow):
+        records = blob.records(fields)
+        blob = blob.blob
+    if isinstance(blob, ShardRow):
+        if records is None:
+            records = blob.records(fields)
+        blob = blob.blob
+    if records is None:
+        records = _read_records(blob, cache, fields)
+    if is_delta(records):
+        if fields is not None and not is_normalized(blob):
+            # The projected read only converted the timestamps among
+            # `fields`, hours are matched on observation_time. Converting
+            # twice gives the same result.
+            records = [scan_and_apply_tz(records[0])]
+        records = resolve_deltas(blob, records, cache)
+        if fields is not None:
+            records = [project(record, fields) for record in records]
+
+    return records, time.perf_counter() - begin
+
+
+def iter_last_json(last, blobs, concurrency=DOWNLOAD_CONCURRENCY, latencies=None,
+                   fields=None):
+    """Records of the blobs at the `last` indexes, in that order.
+
+    Up to `concurrency` blobs are downloaded at once, a window of pending
+    downloads slides over `last`. Each blob is read whole, so memory is
+    bounded by `concurrency` blobs rather than by one record.
+    The download time of each blob is appended to `latencies` as a
+    (name, seconds) pair when given. With `fields`, records only hold
+    those top level keys (plus 'name').
+    """
+    indexes = iter(last)
+    pending = deque()
+
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+        def submit():
+            i = next(indexes, None)
+            if i is not None:
+                blob = blobs[i]
+                pending.append((blob, executor.submit(read_blob, blob, None, fields)))
+
+        try:
+            for _ in range(max(1, concurrency)):
+                submit()
+
+            while pending:
+                blob, future = pending.popleft()
+                records, latency = future.result()
+                submit()
+                if latencies is not None:
+                    latencies.append((blob.name, latency))
+
+                # For hourly forecast, one blob contain several days, they
+                # are yielded one by one in order to replicate the same
+                # structure we have with realtime.
+                for item in records:
+                    item['name'] = blob.name
+                    yield item
+        finally:
+            for _, future in pending:
+                future.cancel()
+
+
+def last_json(last, blobs, concurrency=DOWNLOAD_CONCURRENCY, fields=None):
+    # All the records at once, the request handlers log the downloads.
+    return list(iter_last_json(last, blobs, concurrency, fields=fields))
+
+
+# Bytes of JSON gathered before a streamed response writes them out.
+STREAM_CHUNK_SIZE = 64 * 1024
+
+
+def _buffered(parts, size=STREAM_CHUNK_SIZE):
+    buf = []
+    buffered = 0
+    for part in parts:
+        buf.append(part)
+        buffered += len(part)
+        if buffered >= size:
+            yield ''.join(buf)
+            buf = []
+            buffered = 0
+    if buf:
+        yield ''.join(buf)
+
+
+def iter_json_array(records):
+    # The JSON array of the records, serialized one record at a time.
+    def parts():
+        yield '['
+        separator = ''
+        for record in records:
+            yield separator
+            yield json.dumps(record)
+            separator = ','
+        yield ']'
+    return _buffered(parts())
+
+
+def iter_ndjson(records):
+    return _buffered(json.dumps(record) + '\n' for record in records)
+
+
+def logged_records(records, latencies):
+    # Passes the records through and logs the downloads once all are read.
+    begin = time.perf_counter()
+    yield from records
+    if latencies:
+        print("Read {} blobs in {:.3f}s, slowest {:.3f}s.".format(
+            len(latencies), time.perf_counter() - begin,
+            max(latency for _, latency in latencies)))
+
+
+def name_to_datetime(name):
+    # 'realtime-20201223-191503' -> naive datetime. Names are stamped with
+    # the container clock, which is UTC on Cloud Run.
+    try:
+        return datetime.strptime(' '.join(name.rsplit('-', 2)[1:3]),
+                                 "%Y%m%d %H%M%S")
+    except ValueError:
+        return None
+
+
+def parse_datetime(value):
+    return parse_iso(value) or parse(value)
+
+
+def parse_fields(value):
+    # ?fields=temp,humidity -> frozenset, None when not given.
+    if not value:
+        return None
+    return frozenset(f.strip() for f in value.split(',') if f.strip())
+
+
+STAMP_FORMAT = "%Y%m%d-%H%M%S"
+
+# Blob layouts: flat names are 'realtime-20201223-191503', partitioned ones
+# 'realtime/2020/12/23/realtime-20201223-191503' so a day is listed on its
+# own. Both end with the stamp, the helpers below take either.
+LAYOUTS = ('flat', 'partitioned')
+
+
+def name_stamp(name):
+    # 'realtime-20201223-191503' -> '20201223-191503', sorts like the time.
+    return name[-15:]
+
+
+def name_key(name):
+    # Sort key putting blob names of both layouts in time order.
+    return name_stamp(name), name
+
+
+def partition_prefix(prefix, day):
+    # 'realtime', '20201223' -> 'realtime/2020/12/23/'
+    return '{}/{}/{}/{}/'.format(prefix, day[:4], day[4:6], day[6:8])
+
+
+def stamp_days(lo, hi):
+    # 'YYYYMMDD' days from the day of stamp lo to the day of stamp hi.
+    day = datetime.strptime(lo[:8], "%Y%m%d")
+    end = datetime.strptime(hi[:8], "%Y%m%d")
+    days = []
+    while day <= end:
+        days.append(day.strftime("%Y%m%d"))
+        day += timedelta(days=1)
+    return days
+
+
+def range_stamp(value):
+    """Stamp of a range bound, either a blob name or an ISO datetime.
+
+    Naive datetimes are Toronto time, like the records returned.
+    """
+    dt = name_to_datetime(value)
+    if dt is None:
+        dt = parse_datetime(value)
+        if dt.tzinfo is None:
+            dt = tz.localize(dt)
+        dt = dt.astimezone(tz_utc).replace(tzinfo=None)
+    return dt.strftime(STAMP_FORMAT)
+
+
+def stamp_name(prefix, dt, layout='flat'):
+    # Name a blob stamped at `dt` (naive UTC) would have.
+    name = '{}-{}'.format(prefix, dt.strftime(STAMP_FORMAT))
+    if layout == 'partitioned':
+        return partition_prefix(prefix, name_stamp(name)) + name
+    return name
+
+
+def range_bounds(start, end):
+    # Stamps covering a start/end query, the upper one is exclusive: one
+    # second past the end.
+    lo, hi = sorted((range_stamp(start), range_stamp(end)))
+    hi = datetime.strptime(hi, STAMP_FORMAT) + timedelta(seconds=1)
+    return lo, hi.strftime(STAMP_FORMAT)
+
+
+# Windows tried, doubling from a day, to find the last N blobs of a prefix
+# without a manifest.
+LIST_LAST_MAX_DAYS = 4096
+
+
+# Day partitions listed at the same time.
+LIST_CONCURRENCY = int(os.environ.get('LIST_CONCURRENCY', 8))
+
+
+def list_partitions(list_blobs, prefix, days, concurrency=LIST_CONCURRENCY):
+    # Blobs of the day partitions, listed concurrently.
+    def list_day(day):
+        return list(list_blobs(prefix=partition_prefix(prefix, day)))
+
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+        return [_b for blobs in executor.map(list_day, days) for _b in blobs]
+
+
+def list_range(list_blobs, prefix, lo=None, hi=None, now=None):
+    """Blobs of a prefix stamped in [lo, hi), both layouts.
+
+    `list_blobs` takes the prefix and offsets of Client.list_blobs. Flat
+    blobs are listed between offsets and partitioned ones one day at a
+    time, so the listing grows with the days covered rather than the whole
+    history. Without bounds the whole prefix is listed, without `hi` up to
+    `now`.
+    """
+    if lo is None:
+        return list(list_blobs(prefix=prefix))
+
+    flat = list_blobs(
+        prefix=prefix + '-', start_offset='{}-{}'.format(prefix, lo),
+        end_offset=hi and '{}-{}'.format(prefix, hi))
+    hi = hi or (now or datetime.utcnow()).strftime(STAMP_FORMAT) + '~'
+    days = stamp_days(lo, hi)
+    if hi.endswith('-000000'):
+        # hi is exclusive, nothing of its day is in the range.
+        days = days[:-1]
+    partitioned = [_b for _b in list_partitions(list_blobs, prefix, days)
+                   if lo <= name_stamp(_b.name) < hi]
+    return list(flat) + partitioned
+
+
+def list_blob_last(list_blobs, prefix, last, now=None):
+    # Lists windows ending now, from yesterday then twice as many days each
+    # time, until they hold `last` blobs. Each window only lists the days
+    # the previous one didn't cover.
+    today = (now or datetime.utcnow()).replace(hour=0, minute=0, second=0,
+                                               microsecond=0)
+    blobs = []
+    hi = None
+    days = 1
+    while days <= LIST_LAST_MAX_DAYS:
+        lo = (today - timedelta(days=days)).strftime(STAMP_FORMAT)
+        blobs += list_range(list_blobs, prefix, lo, hi, now)
+        if len(blobs) >= last:
+            return blobs
+        hi = lo
+        days = days * 2
+    return list_range(list_blobs, prefix)
+
+
+def listed_blobs(bucket, blobs):
+    # BucketBlobs of listed blobs, in time order whatever their layout.
+    blobs = sorted(blobs, key=lambda _b: name_key(_b.name))
+    names = [_b.name for _b in blobs]
+    return BucketBlobs(bucket, names, [_b.generation for _b in blobs],
+                       schemas=[(_b.metadata or {}).get('schema') for _b in blobs],
+                       keys=[name_key(name) for name in names])
+
+
+def resolve_range(keys, start, end):
+    """Indexes of the blobs between start and end, both included.
+
+    `keys` are the sorted name_key() of the blobs, like Manifest.keys. The
+    bounds are found by bisecting them, they don't have to be existing blob
+    names. Newest first, like last_range.
+    """
+    lo, hi = sorted((range_stamp(start), range_stamp(end)))
+    first = bisect_left(keys, (lo,))
+    last = bisect_left(keys, (hi + '~',))
+    return range(last - 1, first - 1, -1)
+
+
+class SlotIndex:
+    """Blob names bucketed by ceil_dt slot.
+
+    A slot X holds the blobs stored in (X - delta, X], Toronto time.
+    Looking up a slot is a dict access, a range of k slots is a bisect
+    plus k lookups.
+    """
+
+    def __init__(self, delta=15):
+        self.delta = delta
+        self.slots = {}
+        self.keys = []
+        self.newest = None
+        # Set by the first refresh, names added before it (writes) don't
+        # mean the older blobs are indexed.
+        self.filled = False
+        self.lock = threading.Lock()
+
+    def slot(self, dt):
+        # Naive datetimes are Toronto wall-clock time, like ceil_dt.
+        return ceil_dt(dt, self.delta)
+
+    def add(self, name):
+        dt = name_to_datetime(name)
+        if dt is None:
+            return
+        slot = self.slot(utc_to_toronto(dt))
+        with self.lock:
+            if slot not in self.slots:
+                insort(self.keys, slot)
+                self.slots[slot] = []
+            if name not in self.slots[slot]:
+                self.slots[slot].append(name)
+                self.slots[slot].sort(key=name_key)
+            if self.newest is None or name_key(name) > name_key(self.newest):
+                self.newest = name
+
+    def refresh(self, names_after):
+        """Adds the names of names_after(newest).
+
+        The first refresh asks for every name, names_after(None).
+        """
+        newest = self.newest if self.filled else None
+        for name in names_after(newest):
+            self.add(name)
+        self.filled = True
+
+    def get(self, dt):
+        return list(self.slots.get(self.slot(dt), ()))
+
+    def range(self, start, end):
+        start, end = sorted((self.slot(start), self.slot(end)))
+        with self.lock:
+            keys = self.keys[bisect_left(self.keys, start):
+                             bisect_right(self.keys, end)]
+            return [name for k in keys for name in self.slots[k]]
+
+
+def observation_time(payload):
+    # observation_time of a stored payload, the first forecast hour for an
+    # hourly blob.
+    try:
+        j = json.loads(payload)
+    except ValueError:
+        return None
+    if isinstance(j, list):
+        j = j[0] if j else None
+    if not isinstance(j, dict):
+        return None
+    value = j.get('observation_time')
+    if isinstance(value, dict):
+        value = value.get('value')
+    return value if isinstance(value, str) else None
+
+
+def _number(value):
+    # ClimaCell measurements are {"value": 1.5, "units": "C"}.
+    if isinstance(value, dict):
+        value = value.get('value')
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        return None
+    return value
+
+
+def record_seconds(record):
+    # UTC epoch seconds of a record: its observation_time, the blob name
+    # stamp when it has none.
+    value = record.get('observation_time')
+    if isinstance(value, dict):
+        value = value.get('value')
+    dt = None
+    if isinstance(value, str):
+        try:
+            dt = parse_datetime(value)
+        except (ValueError, OverflowError):
+            dt = None
+    if dt is not None and dt.tzinfo is not None:
+        dt = dt.replace(tzinfo=None) - dt.utcoffset()
+    if dt is None:
+        dt = name_to_datetime(record.get('name', ''))
+    if dt is None:
+        return None
+    return int((dt - datetime(1970, 1, 1)).total_seconds())
+
+
+def records_to_series(records, fields=None):
+    """Sample times and numeric series of realtime records.
+
+    Returns (seconds, {field: values}, {field: units}), values are float64
+    with NaN where a record lacks the field. Without `fields`, every
+    numeric field of the records is used.
+    """
+    records = [r for r in records if isinstance(r, dict)]
+    seconds = [record_seconds(r) for r in records]
+    records = [r for r, s in zip(records, seconds) if s is not None]
+    seconds = [s for s in seconds if s is not None]
+
+    if fields is None:
+        fields = sorted({k for r in records for k, v in r.items()
+                         if k != 'name' and _number(v) is not None})
+    series = {}
+    units = {}
+    for field in fields:
+        values = [_number(r.get(field)) for r in records]
+        series[field] = np.array([np.nan if v is None else v for v in values],
+                                 dtype='float64')
+        for r in records:
+            if isinstance(r.get(field), dict) and 'units' in r[field]:
+                units[field] = r[field]['units']
+                break
+
+    return np.array(seconds, dtype='int64'), series, units
+
+
+def aggregate_records(records, fields=None, bucket='1h', agg='mean'):
+    """Downsampled series of the records, a compact JSON-able dict.
+
+    Hourly buckets are labelled with their Toronto start time, daily ones
+    with the Toronto date. Empty buckets are left out, a bucket without a
+    value for a field holds None.
+    """
+    seconds, series, units = records_to_series(records, fields)
+    keys, out = aggregate(seconds, series, bucket, agg)
+    if bucket == '1d':
+        labels = [(datetime(1970, 1, 1) + timedelta(seconds=int(k))).date().isoformat()
+                  for k in keys]
+    else:
+        labels = [utc_to_toronto(datetime.utcfromtimestamp(int(k))).isoformat()
+                  for k in keys]
+
+    result = {"bucket": bucket, "agg": agg, "time": labels, "units": units}
+    for field, values in out.items():
+        result[field] = [None if np.isnan(v) else float(v) for v in values.tolist()]
+    return result
+
+
+# Delta forecasts: successive hourly forecasts mostly cover the same
+# target hours with the same values, so a forecast can be stored as the
+# changes since the previous one,
+# {"delta": 1, "base": name, "base_generation": generation, "hours": [...]}
+# Each hour holds its observation_time, the fields "set" (every field for
+# a new target hour) and the fields "unset" since the base.
+DELTA_KEY = "delta"
+
+
+def is_delta(records):
+    return (len(records) == 1 and isinstance(records[0], dict)
+            and DELTA_KEY in records[0])
+
+
+def _forecast_hour(record):
+    value = record.get('observation_time')
+    if isinstance(value, dict):
+        value = value.get('value')
+    return value if isinstance(value, str) else None
+
+
+def _is_forecast(records):
+    return (isinstance(records, list) and
+            all(isinstance(r, dict) and _forecast_hour(r) for r in records))
+
+
+def forecast_delta(base_name, base_generation, base, forecast):
+    """Delta document of a forecast against the previous one.
+
+    None when either isn't a list of hourly records, the forecast is
+    stored in full then.
+    """
+    if not _is_forecast(base) or not _is_forecast(forecast):
+        return None
+
+    by_hour = {_forecast_hour(r): r for r in base}
+    hours = []
+    for record in forecast:
+        previous = by_hour.get(_forecast_hour(record), {})
+        hour = {"observation_time": record["observation_time"]}
+        changed = {k: v for k, v in record.items()
+                   if k not in previous or previous[k] != v}
+        unset = [k for k in previous if k not in record]
+        if changed:
+            hour["set"] = changed
+        if unset:
+            hour["unset"] = unset
+        hours.append(hour)
+
+    return {DELTA_KEY: 1, "base": base_name, "base_generation": base_generation,
+            "hours": hours}
+
+
+def apply_delta(base, delta):
+    by_hour = {_forecast_hour(r): r for r in base}
+    records = []
+    for hour in delta["hours"]:
+        record = dict(by_hour.get(_forecast_hour(hour), {}))
+        record.update(hour.get("set", {}))
+        for field in hour.get("unset", ()):
+            record.pop(field, None)
+        records.append(record)
+    return records
+
+
+class Manifest:
+    """Sorted blob names of a prefix with their observation time and size.
+
+    Kept as a single object next to the data so reads never have to list
+    the prefix. Columns are stored side by side to keep it compact.
+    """
+
+    def __init__(self, prefix, names=None, times=None, sizes=None,
+                 generations=None, segments=None, shards=None, schemas=None):
+        self.prefix = prefix
+        # Compacted days, 'YYYYMMDD' -> [segment blob name, generation]
+        self.segments = segments or {}
+        # Shard written periods, 'YYYYMMDD' or 'YYYYMMDD-HH' -> shard name.
+        self.shards = shards or {}
+        self.names = names or []
+        self.times = times or [None] * len(self.names)
+        self.sizes = sizes or [None] * len(self.names)
+        self.generations = generations or [None] * len(self.names)
+        self.schemas = schemas or [None] * len(self.names)
+
+        # Names are kept in time order whatever their layout.
+        self.keys = [name_key(name) for name in self.names]
+        if any(a > b for a, b in zip(self.keys, self.keys[1:])):
+            order = sorted(range(len(self.keys)), key=self.keys.__getitem__)
+            for column in ('names', 'times', 'sizes', 'generations', 'schemas', 'keys'):
+                values = getattr(self, column)
+                setattr(self, column, [values[i] for i in order])
+
+    def __len__(self):
+        return len(self.names)
+
+    def index(self, name):
+        # Position of a name, None when it isn't in the manifest.
+        i = bisect_left(self.keys, name_key(name))
+        if i < len(self.names) and self.names[i] == name:
+            return i
+        return None
+
+    def after(self, name):
+        # Names newer than `name`.
+        return self.names[bisect_right(self.keys, name_key(name)):]
+
+    def add(self, name, size=None, observation_time=None, generation=None,
+            schema=None):
+        i = bisect_left(self.keys, name_key(name))
+        if i < len(self.names) and self.names[i] == name:
+            self.times[i] = observation_time or self.times[i]
+            self.sizes[i] = size if size is not None else self.sizes[i]
+            self.generations[i] = generation or self.generations[i]
+            self.schemas[i] = schema or self.schemas[i]
+            return
+        self.names.insert(i, name)
+        self.keys.insert(i, name_key(name))
+        self.times.insert(i, observation_time)
+        self.sizes.insert(i, size)
+        self.generations.insert(i, generation)
+        self.schemas.insert(i, schema)
+
+    def dumps(self):
+        return json.dumps({
+            "version": 1,
+            "prefix": self.prefix,
+            "names": self.names,
+            "times": self.times,
+            "sizes": self.sizes,
+            "generations": self.generations,
+            "schemas": self.schemas,
+            "segments": self.segments,
+            "shards": self.shards,
+        }, separators=(',', ':'))
+
+    @classmethod
+    def loads(cls, data):
+        j = json.loads(data)
+        return cls(j["prefix"], j["names"], j["times"], j["sizes"],
+                   j.get("generations"), j.get("segments"), j.get("shards"),
+                   j.get("schemas"))
+
+    def add_segment(self, day, name, generation):
+        self.segments[day] = [name, generation]
+
+    def add_shard(self, period, name):
+        self.shards[period] = name
+
+    def day_names(self, day):
+        # Names stamped on a UTC day, 'YYYYMMDD'.
+        return self.names[bisect_left(self.keys, (day,)):
+                          bisect_left(self.keys, (day + '~',))]
+
+
+MANIFEST_PREFIX = "manifest/"
+MANIFEST_RETRIES = 5
+
+
+def update_manifest(bucket, prefix, update, description, rebuild):
+    """Apply `update` to the manifest of a prefix and save it.
+
+    Writes are conditional on the manifest generation so concurrent
+    instances don't lose each other's updates, a conflict is retried.
+    `rebuild(prefix)` builds the manifest when there is none yet. None
+    when it kept conflicting.
+    """
+    for attempt in range(MANIFEST_RETRIES):
+        blob = bucket.get_blob(MANIFEST_PREFIX + prefix)
+        try:
+            if blob is None:
+                manifest = rebuild(prefix)
+                manifest_generation = 0
+            else:
+                manifest_generation = blob.generation
+                manifest = Manifest.loads(blob.download_as_string(
+                    if_generation_match=manifest_generation))
+
+            update(manifest)
+            bucket.blob(MANIFEST_PREFIX + prefix).upload_from_string(
+                data=manifest.dumps(),
+                content_type='application/json',
+                if_generation_match=manifest_generation)
+            return manifest
+        except PreconditionFailed:
+            print("Manifest {} changed, retrying.".format(prefix))
+
+    print("error: manifest {} not updated with {}".format(prefix, description))
+    return None
+
+
+class BucketBlobs:
+    # Sequence of blobs built on demand from their names, nothing is
+    # listed or fetched until a blob is actually read. Blobs are pinned
+    # to their generation when it is known, blobs of a compacted day are
+    # read from its segment, records appended to a shard from the shard.
+    # `keys` are the name_key() of the names, for resolve_range.
+    def __init__(self, bucket, names, generations=None, segments=None, shards=None,
+                 schemas=None, keys=None):
+        self.bucket = bucket
+        self.names = names
+        self.keys = keys
+        self.generations = generations
+        self.segments = segments
+        self.shards = shards
+        self.schemas = schemas
+
+    def __len__(self):
+        return len(self.names)
+
+    def __getitem__(self, i):
+        generation = self.generations[i] if self.generations else None
+        blob = self.bucket.blob(self.names[i], generation=generation)
+        if self.schemas and self.schemas[i]:
+            # Known from the manifest or the listing, saves fetching it.
+            blob.metadata = {"schema": self.schemas[i]}
+        if self.shards:
+            stamp = name_stamp(self.names[i])
+            shard = self.shards.get(stamp[:11]) or self.shards.get(stamp[:8])
+            if shard is not None:
+                blob = ShardRow(blob, shard)
+        if self.segments:
+            segment = self.segments.get(name_stamp(self.names[i])[:8])
+            if segment is not None:
+                return SegmentRow(blob, segment[0], segment[1])
+        return blob
+
+
+SEGMENT_PREFIX = "segments/"
+SEGMENT_CACHE_SIZE = 64
+_segments = OrderedDict()
+_segments_lock = threading.Lock()
+
+
+def segment_name(prefix, day):
+    return "{}{}-{}.npz".format(SEGMENT_PREFIX, prefix, day)
+
+
+def load_segment(bucket, name, generation):
+    # Segments never change for a generation, the last ones read are kept.
+    key = (name, generation)
+    with _segments_lock:
+        segment = _segments.get(key)
+        if segment is not None:
+            _segments.move_to_end(key)
+            return segment
+
+    segment = Segment(bucket.blob(name, generation=generation).download_as_string())
+    with _segments_lock:
+        _segments[key] = segment
+        while len(_segments) > SEGMENT_CACHE_SIZE:
+            _segments.popitem(last=False)
+    return segment
+
+
+class SegmentRow:
+    # A blob of a compacted day, its record is read from the day segment.
+    def __init__(self, blob, segment, generation):
+        self.blob = blob
+        self.segment = segment
+        self.segment_generation = generation
+
+    @property
+    def name(self):
+        return self.blob.name
+
+    def records(self, fields=None):
+        # None when the segment doesn't hold this blob (written after the
+        # compaction), the raw blob has to be read then. With `fields` only
+        # those columns are read.
+        segment = load_segment(self.blob.bucket, self.segment, self.segment_generation)
+        record = segment.records([self.name], fields)[0]
+        if record is None:
+            return None
+        if segment.meta.get("schema") == TZ_SCHEMA:
+            return [record]
+        return [scan_and_apply_tz(record)]
+
+
+# Shards hold the records of an hour or a day as NDJSON, one line per
+# Pub/Sub push: {"name": "realtime-20201223-191503", "record": {...}}.
+SHARD_PREFIX = "shards/"
+SHARD_PERIODS = {'hour': 11, 'day': 8}  # length of the stamp prefix
+SHARD_CACHE_SIZE = 16
+_shards = OrderedDict()
+_shards_lock = threading.Lock()
+
+
+def shard_period(name, period):
+    # 'realtime-20201223-191503' -> '20201223-19' by hour, '20201223' by day.
+    return name_stamp(name)[:SHARD_PERIODS[period]]
+
+
+def shard_name(prefix, period_key):
+    return "{}{}-{}.ndjson".format(SHARD_PREFIX, prefix, period_key)
+
+
+def shard_line(name, payload, schema=None):
+    # The payload is compacted on one line, kept as a string when it isn't
+    # JSON. `schema` marks a normalized payload like the blob metadata.
+    try:
+        record = json.loads(payload)
+    except ValueError:
+        record = payload
+    row = {"name": name, "record": record}
+    if schema is not None:
+        row["schema"] = schema
+    return json.dumps(row, separators=(',', ':')) + '\n'
+
+
+def parse_shard(data, convert=False):
+    # name -> record of the lines of a shard, the first line wins when a
+    # redelivered push was appended twice. With `convert`, the records not
+    # normalized when written are converted to Toronto time.
+    rows = {}
+    for line in decompress(data).decode('utf-8').splitlines():
+        if line.strip():
+            row = json.loads(line)
+            record = row["record"]
+            if convert and row.get("schema") != TZ_SCHEMA:
+                record = scan_and_apply_tz(record)
+            rows.setdefault(row["name"], record)
+    return rows
+
+
+def load_shard(bucket, name, generation=None):
+    """Converted records of a shard, at least as recent as `generation`.
+
+    Shards only ever get lines appended, so a newer generation holds every
+    record of the older ones and the live object is read.
+    """
+    with _shards_lock:
+        cached = _shards.get(name)
+        if cached is not None and (generation or 0) <= (cached[0] or 0):
+            _shards.move_to_end(name)
+            return cached[1]
+
+    blob = bucket.blob(name)
+    rows = parse_shard(blob.download_as_string(), convert=True)
+    with _shards_lock:
+        _shards[name] = (blob.generation, rows)
+        while len(_shards) > SHARD_CACHE_SIZE:
+            _shards.popitem(last=False)
+    return rows
+
+
+class ShardRow:
+    # A record appended to a shard, the manifest generation is the one of
+    # the shard right after the append.
+    def __init__(self, blob, shard):
+        self.blob = blob
+        self.shard = shard
+
+    @property
+    def name(self):
+        return self.blob.name
+
+    def records(self, fields=None):
+        # None when the shard doesn't hold it (written as its own object),
+        # the raw blob has to be read then.
+        rows = load_shard(self.blob.bucket, self.shard, self.blob.generation)
+        if self.name not in rows:
+            return None
+        return [project(dict(r) if isinstance(r, dict) else r, fields)
+                for r in _as_list(rows[self.name])]
+
+    def raw(self):
+        rows = parse_shard(self.blob.bucket.blob(self.shard).download_as_string())
+        return _as_list(rows[self.name]) if self.name in rows else None
+
+
+SHARD_RETRIES = 5
+# GCS composite objects are limited to 1024 components, a shard is
+# rewritten as a single component before reaching it.
+SHARD_MAX_COMPONENTS = 1000
+
+
+def append_to_shard(bucket, prefix, filename, payload, period, schema=None):
+    """Append a payload as one line of the shard of its `period`.
+
+    The line is uploaded as a part object then composed at the end of the
+    shard, conditional on the shard generation so concurrent appends are
+    retried rather than lost. Once this returns, the line is stored like
+    any GCS object; None when the shard kept changing, nothing was
+    appended then.
+    """
+    shard = bucket.blob(shard_name(prefix, shard_period(filename, period)))
+    line = shard_line(filename, payload, schema)
+    part = bucket.blob(SHARD_PREFIX + "parts/" + filename)
+    part.upload_from_string(data=line, content_type='application/x-ndjson')
+    try:
+        for attempt in range(SHARD_RETRIES):
+            current = bucket.get_blob(shard.name)
+            try:
+                if current is None:
+                    shard.compose([part], if_generation_match=0)
+                elif (current.component_count or 1) >= SHARD_MAX_COMPONENTS:
+                    data = current.download_as_string(
+                        if_generation_match=current.generation)
+                    shard.upload_from_string(
+                        data=data + line.encode('utf-8'),
+                        content_type='application/x-ndjson',
+                        if_generation_match=current.generation)
+                else:
+                    shard.compose([current, part],
+                                  if_generation_match=current.generation)
+                return shard
+            except PreconditionFailed:
+                print("Shard {} changed, retrying.".format(shard.name))
+    finally:
+        part.delete()
+
+    print("error: {} not appended to shard {}".format(filename, shard.name))
+    return None
+
+
+def _as_list(record):
+    # An hourly forecast is a list of records, like a stored array.
+    return record if isinstance(record, list) else [record]
+
+
+def read_raw_records(blobs, concurrency=DOWNLOAD_CONCURRENCY):
+    # Records of each blob as stored, without any conversion, tagged with
+    # the blob name. Used to compact them.
+    def read(blob):
+        if isinstance(blob, ShardRow):
+            items = blob.raw()
+            if items is not None:
+                return blob.name, [dict(i) for i in items]
+            blob = blob.blob
+        with blob.open('rb', chunk_size=READ_CHUNK_SIZE) as f:
+            chunks = decompress_chunks(iter(lambda: f.read(READ_CHUNK_SIZE), b''))
+            return blob.name, list(iter_json_records(chunks))
+
+    records = []
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+        for name, items in executor.map(read, blobs):
+            for item in items:
+                item['name'] = name
+                records.append(item)
+    return records
+
+
+# Latest writes kept for the latency metrics of WriteBehind.stats().
+WRITE_LATENCY_SAMPLES = 1000
+
+
+def _summary(values):
+    values = sorted(values)
+    if not values:
+        return {"count": 0}
+    return {
+        "count": len(values),
+        "mean": sum(values) / len(values),
+        "p50": values[len(values) // 2],
+        "p95": values[min(len(values) - 1, int(len(values) * 0.95))],
+        "max": values[-1],
+    }
+
+
+def _describe(args):
+    # The payload, last, is left out of the logs.
+    return ' '.join(str(a) for a in args[:-1])
+
+
+class WriteBehind:
+    """Writes done by background threads from a bounded queue.
+
+    submit() returns False when the queue is full or drained, nothing was
+    queued then. A write raising or returning None is retried with
+    exponential backoff, `failed` is called with its arguments once the
+    retries are exhausted. drain() waits for the queued writes.
+    """
+
+    def __init__(self, write, workers=2, max_queue=256, retries=5, backoff=0.5,
+                 failed=None):
+        self.write = write
+        self.failed = failed
+        self.retries = retries
+        self.backoff = backoff
+        self.queue = queue.Queue(max_queue)
+        self.lock = threading.Lock()
+        # (upload seconds, seconds since queued) of the latest writes
+        self.latencies = deque(maxlen=WRITE_LATENCY_SAMPLES)
+        self.written = self.retried = self.failures = self.rejected = 0
+        self.closed = False
+        self.threads = [threading.Thread(target=self._work, daemon=True)
+                        for _ in range(max(1, workers))]
+        for thread in self.threads:
+            thread.start()
+
+    def submit(self, *args):
+        if not self.closed:
+            try:
+                self.queue.put_nowait((time.perf_counter(), args))
+                return True
+            except queue.Full:
+                pass
+        with self.lock:
+            self.rejected += 1
+        return False
+
+    def _work(self):
+        while True:
+            queued, args = self.queue.get()
+            try:
+                self._write(queued, args)
+            finally:
+                self.queue.task_done()
+
+    def _write(self, queued, args):
+        for attempt in range(self.retries + 1):
+            if attempt:
+                time.sleep(self.backoff * 2 ** (attempt - 1))
+                with self.lock:
+                    self.retried += 1
+            begin = time.perf_counter()
+            try:
+                written = self.write(*args) is not None
+            except Exception as e:
+                print("error: write of {} failed: {!r}".format(_describe(args), e))
+                written = False
+            if written:
+                end = time.perf_counter()
+                with self.lock:
+                    self.written += 1
+                    self.latencies.append((end - begin, end - queued))
+                return
+
+        with self.lock:
+            self.failures += 1
+        print("error: write of {} given up after {} retries".format(
+            _describe(args), self.retries))
+        if self.failed is not None:
+            self.failed(*args)
+
+    def drain(self, timeout=None):
+        # Stops taking writes and waits up to `timeout` seconds for the
+        # queued ones, True when they were all written.
+        self.closed = True
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.queue.all_tasks_done:
+            while self.queue.unfinished_tasks:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    break
+                self.queue.all_tasks_done.wait(remaining)
+            return self.queue.unfinished_tasks == 0
+
+    def stats(self):
+        with self.lock:
+            latencies = list(self.latencies)
+            counts = {"written": self.written, "retried": self.retried,
+                      "failed": self.failures, "rejected": self.rejected}
+        return dict(counts,
+                    depth=self.queue.qsize(),
+                    max_depth=self.queue.maxsize,
+                    upload_seconds=_summary(l[0] for l in latencies),
+                    queued_seconds=_summary(l[1] for l in latencies))
@@ -0,0 +1,727 @@
+'''
+pip install -U pytest
+
+> pytest
+'''
+
+import copy
+from datetime import datetime
+import io
+import json
+import threading
+import time
+
+from google.api_core.exceptions import PreconditionFailed
+import pytest
+
+from store import stamp_name, stamp_days, name_to_datetime, TZ_SCHEMA, \
+    normalize_payload, WriteBehind, forecast_delta, apply_delta, compress, \
+    decompress_chunks, shard_line, shard_name, shard_period, load_shard, \
+    read_raw_records, iter_json_records, iter_json_array, iter_ndjson, \
+    BucketBlobs, segment_name, resolve_range, name_key, range_bounds, \
+    iter_last_json, last_json, BlobCache, read_blob, SlotIndex, Manifest, \
+    observation_time, aggregate_records, append_to_shard, update_manifest, \
+    SHARD_MAX_COMPONENTS, MANIFEST_PREFIX, MANIFEST_RETRIES, parse_shard, \
+    list_range, list_blob_last, listed_blobs
+from yadt import scan_and_apply_tz, tz_object_hook, tz
+from yadt_test import lst
+from columnar import dumps_segment
+
+
+class MemoryBlob:
+    # Just enough of google.cloud.storage.Blob for the readers and writers.
+    def __init__(self, name, payload, generation=None):
+        self.name = name
+        self.payload = payload.encode('utf-8') if isinstance(payload, str) else payload
+        self.generation = generation
+        self.component_count = None
+        self.metadata = None
+        self.reads = 0
+
+    def open(self, mode='rb', chunk_size=None):
+        self.reads += 1
+        return io.BytesIO(self.payload)
+
+    def download_as_string(self, if_generation_match=None):
+        if if_generation_match is not None:
+            self.bucket.check(self.name, if_generation_match)
+        self.reads += 1
+        return self.payload
+
+    def upload_from_string(self, data, content_type=None, if_generation_match=None):
+        self.bucket.check(self.name, if_generation_match)
+        self.payload = data.encode('utf-8') if isinstance(data, str) else data
+        self.component_count = None
+        self.bucket.store(self)
+
+    def compose(self, sources, if_generation_match=None):
+        self.bucket.check(self.name, if_generation_match)
+        self.payload = b''.join(source.payload for source in sources)
+        self.component_count = sum(source.component_count or 1
+                                   for source in sources)
+        self.bucket.store(self)
+
+    def delete(self):
+        del self.bucket.blobs[self.name]
+
+
+class MemoryBucket:
+    def __init__(self, blobs):
+        self.blobs = {blob.name: blob for blob in blobs}
+        for blob in blobs:
+            blob.bucket = self
+        self.generation = 1000
+        # The next `conflicts` conditional writes fail, as if another
+        # instance had written first.
+        self.conflicts = 0
+
+    def blob(self, name, generation=None):
+        if name not in self.blobs:
+            # Like GCS, a blob can be named before it exists.
+            blob = MemoryBlob(name, '', generation)
+            blob.bucket = self
+            return blob
+        return self.blobs[name]
+
+    def get_blob(self, name):
+        return self.blobs.get(name)
+
+    def check(self, name, if_generation_match):
+        if if_generation_match is None:
+            return
+        if self.conflicts:
+            self.conflicts -= 1
+            raise PreconditionFailed(name)
+        current = self.blobs.get(name)
+        if if_generation_match != (current.generation if current else 0):
+            raise PreconditionFailed(name)
+
+    def store(self, blob):
+        self.generation += 1
+        blob.generation = self.generation
+        self.blobs[blob.name] = blob
+
+
+class MemoryListing:
+    # Client.list_blobs over blob names, recording the listings asked for.
+    def __init__(self, names):
+        self.blobs = [MemoryBlob(name, '', i) for i, name in enumerate(names)]
+        self.calls = []
+
+    def __call__(self, prefix, start_offset=None, end_offset=None):
+        self.calls.append(prefix)
+        return [blob for blob in self.blobs if blob.name.startswith(prefix)
+                and (start_offset is None or blob.name >= start_offset)
+                and (end_offset is None or blob.name < end_offset)]
+
+
+def chunked(data, size):
+    data = data.encode('utf-8')
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+def test_iter_json_records_array():
+    for size in (1, 7, 4096):
+        records = list(iter_json_records(chunked(json.dumps(lst, indent=2), size)))
+        assert records == lst
+
+
+def test_iter_json_records_converts_while_decoding():
+    records = list(iter_json_records(chunked(json.dumps(lst), 13),
+                                     object_hook=tz_object_hook))
+
+    assert records == scan_and_apply_tz(lst)
+
+
+def test_iter_json_records_single_document():
+    records = list(iter_json_records(chunked(json.dumps(lst[0]), 5)))
+
+    assert records == [lst[0]]
+
+
+def test_iter_json_records_scalars_and_multibyte():
+    payload = json.dumps([12345, "été", [], {}], ensure_ascii=False)
+
+    assert list(iter_json_records(chunked(payload, 1))) == [12345, "été", [], {}]
+    assert list(iter_json_records(chunked('[ ]', 1))) == []
+
+
+def test_iter_json_records_truncated():
+    with pytest.raises(json.JSONDecodeError):
+        list(iter_json_records(chunked(json.dumps(lst)[:-10], 64)))
+
+
+def test_last_json():
+    blobs = [
+        MemoryBlob("hourly-20201223-100003", json.dumps(lst[1:])),
+        MemoryBlob("realtime-20201223-191503", json.dumps(lst[0])),
+    ]
+
+    records = last_json(range(-1, -3, -1), blobs)
+
+    assert len(records) == len(lst)
+    assert records[0]["name"] == "realtime-20201223-191503"
+    assert records[1]["name"] == "hourly-20201223-100003"
+    assert records[0]["observation_time"][
+        "value"] == '2020-12-23T14:15:01.835000-05:00'
+
+
+def test_slot_index():
+    index = SlotIndex()
+    for name in ("realtime-20201223-191503", "realtime-20201223-181503",
+                 "realtime-20201223-190003", "realtime-20201223-184500",
+                 "realtime-20201223-191503", "realtime-20201108-054500"):
+        index.add(name)
+
+    # 19:15:03 UTC is 14:15:03 EST, ceil_dt puts it in the 14:30 slot.
+    assert index.get(datetime(2020, 12, 23, 14, 30)) == ["realtime-20201223-191503"]
+    assert index.get(datetime(2020, 12, 23, 14, 20)) == ["realtime-20201223-191503"]
+    assert index.get(tz.localize(datetime(2020, 12, 23, 14, 15))) == ["realtime-20201223-190003"]
+    assert index.get(datetime(2020, 12, 23, 12, 0)) == []
+    assert index.range(datetime(2020, 12, 23, 14, 30), datetime(2020, 12, 23, 13, 45)) == [
+        "realtime-20201223-184500", "realtime-20201223-190003",
+        "realtime-20201223-191503"]
+    assert index.newest == "realtime-20201223-191503"
+
+
+def test_slot_index_refresh_after_write():
+    stored = ["realtime-20201223-181503", "realtime-20201223-184500"]
+    asked = []
+
+    def names_after(newest):
+        asked.append(newest)
+        return [name for name in stored if newest is None or name > newest]
+
+    # A push indexed before the first read must not hide the history.
+    index = SlotIndex()
+    index.add("realtime-20201223-191503")
+    stored.append("realtime-20201223-191503")
+    index.refresh(names_after)
+    assert index.range(datetime(2020, 12, 23, 13, 30), datetime(2020, 12, 23, 14, 30)) == stored
+
+    stored.append("realtime-20201223-192003")
+    index.refresh(names_after)
+    assert asked == [None, "realtime-20201223-191503"]
+    assert index.get(datetime(2020, 12, 23, 14, 30)) == stored[2:]
+
+
+def test_manifest():
+    manifest = Manifest("realtime")
+    manifest.add("realtime-20201223-191503", 1200, "2020-12-23T14:15:01.835000-05:00")
+    manifest.add("realtime-20201223-181503", 1100)
+    manifest.add("realtime-20201223-181503", 1150, "2020-12-23T13:15:01.649000-05:00")
+
+    loaded = Manifest.loads(manifest.dumps())
+
+    assert loaded.names == ["realtime-20201223-181503", "realtime-20201223-191503"]
+    assert loaded.sizes == [1150, 1200]
+    assert loaded.times[0] == "2020-12-23T13:15:01.649000-05:00"
+    assert len(loaded) == 2
+
+
+def test_observation_time():
+    assert observation_time(json.dumps(lst[0])) == "2020-12-23T19:15:01.835Z"
+    assert observation_time(json.dumps(lst[1:])) == "2020-12-23T18:15:01.649Z"
+    assert observation_time("not json") is None
+
+
+class SlowBlob(MemoryBlob):
+    def open(self, mode='rb', chunk_size=None):
+        time.sleep(0.05)
+        return super().open(mode, chunk_size)
+
+
+def test_last_json_concurrent_keeps_order():
+    blobs = [SlowBlob("realtime-20201223-%06d" % i, json.dumps(lst[i % len(lst)]))
+             for i in range(16)]
+    latencies = []
+
+    begin = time.perf_counter()
+    records = list(iter_last_json(range(-1, -17, -1), blobs, 8, latencies))
+    elapsed = time.perf_counter() - begin
+
+    assert [r["name"] for r in records] == [b.name for b in blobs[::-1]]
+    assert [name for name, _ in latencies] == [b.name for b in blobs[::-1]]
+    assert all(latency >= 0.05 for _, latency in latencies)
+    assert elapsed < 16 * 0.05 / 2
+
+
+def test_blob_cache_keyed_by_generation():
+    cache = BlobCache(1024 * 1024)
+    blob = MemoryBlob("realtime-20201223-191503", json.dumps(lst[0]), 1608750903)
+
+    first, _ = read_blob(blob, cache)
+    second, _ = read_blob(blob, cache)
+    other, _ = read_blob(MemoryBlob(blob.name, json.dumps(lst[1]), 1608750904), cache)
+
+    assert blob.reads == 1
+    assert first == second
+    assert first[0]["sunrise"]["value"] == '2020-12-23T07:24:53.968000-05:00'
+    assert other[0]["temp"] == lst[1]["temp"]
+    assert cache.stats()["hits"] == 1
+    assert cache.stats()["misses"] == 2
+
+    # Without a generation, nothing is cached.
+    blob = MemoryBlob("realtime-20201223-181503", json.dumps(lst[1]))
+    read_blob(blob, cache)
+    read_blob(blob, cache)
+    assert blob.reads == 2
+
+
+def test_blob_cache_evicts_by_size():
+    cache = BlobCache(2500)
+    for i in range(3):
+        cache.put("realtime-%d" % i, 1, [lst[i]], 1000)
+
+    assert cache.get("realtime-0", 1) is None
+    assert cache.get("realtime-2", 1) == [lst[2]]
+    assert cache.stats()["bytes"] == 2000
+
+
+def test_blob_cache_disk_tier(tmp_path):
+    cache = BlobCache(1024 * 1024, str(tmp_path), 1024 * 1024)
+    cache.put("realtime/2020/12/23/realtime-20201223-191503", 7, [lst[0]], 1000)
+
+    reopened = BlobCache(1024 * 1024, str(tmp_path), 1024 * 1024)
+
+    assert reopened.get("realtime/2020/12/23/realtime-20201223-191503", 7) == [lst[0]]
+    assert reopened.stats()["disk_hits"] == 1
+    assert reopened.get("realtime/2020/12/23/realtime-20201223-191503", 8) is None
+
+
+def test_resolve_range():
+    names = ["realtime-20201223-171503", "realtime-20201223-181503",
+             "realtime-20201223-191503", "realtime-20201223-201503"]
+    keys = [name_key(name) for name in names]
+
+    # Exact names, either order, both ends included.
+    assert list(resolve_range(keys, names[2], names[1])) == [2, 1]
+    assert list(resolve_range(keys, names[1], names[2])) == [2, 1]
+    assert list(resolve_range(keys, names[1], names[1])) == [1]
+    # Naive ISO datetimes are Toronto time (EST, UTC-5).
+    assert list(resolve_range(keys, "2020-12-23T13:00:00", "2020-12-23T14:20:00")) == [2, 1]
+    assert list(resolve_range(keys, "2020-12-23T19:00:00Z", "2020-12-24")) == [3, 2]
+    assert list(resolve_range(keys, "2020-12-22", "2020-12-23T01:00:00")) == []
+
+
+def test_range_bounds():
+    assert range_bounds("realtime-20201116-001503", "realtime-20201115-101503") == (
+        "20201115-101503", "20201116-001504")
+    assert range_bounds("2020-12-23", "2020-12-23T23:59:59") == (
+        "20201223-050000", "20201224-050000")
+
+
+def test_last_json_reads_compacted_days_from_segment():
+    segment = MemoryBlob(segment_name("realtime", "20201223"), "")
+    segment.payload = dumps_segment(lst[:2])
+    raw = [MemoryBlob(record["name"], json.dumps(record)) for record in lst[:3]][::-1]
+    bucket = MemoryBucket(raw + [segment])
+    blobs = BucketBlobs(bucket, [blob.name for blob in raw], None,
+                        {"20201223": [segment.name, 1]})
+
+    records = last_json(range(2, -1, -1), blobs, concurrency=1)
+
+    assert records == scan_and_apply_tz(lst[:3])
+    assert segment.reads == 1
+    # Not in the segment, read from its blob.
+    assert [blob.reads for blob in raw] == [1, 0, 0]
+
+
+def test_streamed_json():
+    chunks = list(iter_json_array(iter(lst)))
+
+    assert json.loads(''.join(chunks)) == lst
+    assert ''.join(iter_json_array(iter([]))) == '[]'
+    assert [json.loads(line) for line in ''.join(iter_ndjson(iter(lst))).splitlines()] == lst
+
+
+def test_last_json_fields():
+    blobs = [MemoryBlob("hourly-20201223-100003", json.dumps(lst[1:]), 3),
+             MemoryBlob("realtime-20201223-191503", json.dumps(lst[0]), 4)]
+    fields = frozenset(["temp", "sunrise"])
+
+    records = last_json(range(-1, -3, -1), blobs, fields=fields)
+
+    assert records[0] == {"temp": lst[0]["temp"], "name": "realtime-20201223-191503",
+                          "sunrise": {"value": '2020-12-23T07:24:53.968000-05:00'}}
+    assert all(set(r) == {"temp", "sunrise", "name"} for r in records)
+
+    # Full reads fill the cache, projected reads then come from it.
+    last_json(range(-1, -3, -1), blobs)
+    assert last_json(range(-1, -3, -1), blobs, fields=fields) == records
+    assert [blob.reads for blob in blobs] == [2, 2]
+
+
+def test_aggregate_records():
+    records = []
+    for i, temp in enumerate([1.0, 2.0, 3.0, None, 5.0]):
+        record = copy.deepcopy(lst[0])
+        record["observation_time"] = {
+            "value": "2020-12-23T{}:{:02d}:00-05:00".format(14 + i // 4, i % 4 * 15)}
+        record["temp"]["value"] = temp
+        records.append(record)
+
+    result = aggregate_records(records, ["temp"], '1h', 'mean')
+
+    assert result == {"bucket": '1h', "agg": 'mean',
+                      "time": ['2020-12-23T14:00:00-05:00', '2020-12-23T15:00:00-05:00'],
+                      "units": {"temp": lst[0]["temp"]["units"]},
+                      "temp": [2.0, 5.0]}
+
+
+def test_shard_records_read_through_manifest():
+    names = ["realtime-20201223-190003", "realtime-20201223-191503",
+             "realtime-20201223-193003"]
+    period = shard_period(names[0], 'hour')
+    shard = MemoryBlob(shard_name("realtime", period),
+                       shard_line(names[0], json.dumps(lst[0], indent=2)) +
+                       shard_line(names[2], json.dumps(lst[2])), 7)
+    # Written as its own object before the shard writes were turned on.
+    raw = MemoryBlob(names[1], json.dumps(lst[1]), 5)
+    bucket = MemoryBucket([shard, raw])
+
+    manifest = Manifest("realtime")
+    for name, generation in zip(names, [6, 5, 7]):
+        manifest.add(name, generation=generation)
+    manifest.add_shard(period, shard.name)
+    manifest = Manifest.loads(manifest.dumps())
+    blobs = BucketBlobs(bucket, manifest.names, manifest.generations,
+                        manifest.segments, manifest.shards)
+
+    records = last_json(range(-1, -4, -1), blobs)
+    assert [r["name"] for r in records] == names[::-1]
+    assert records[2]["sunrise"]["value"] == '2020-12-23T07:24:53.968000-05:00'
+    assert records[1]["temp"] == lst[1]["temp"]
+
+    # Compaction reads the records as they were pushed.
+    assert read_raw_records(blobs)[0] == dict(lst[0], name=names[0])
+
+    # A line appended since is read once the manifest knows about it.
+    shard.payload += shard_line("realtime-20201223-194503", json.dumps(lst[3])).encode()
+    shard.generation = 8
+    assert "realtime-20201223-194503" in load_shard(bucket, shard.name, 8)
+
+
+def test_append_to_shard():
+    bucket = MemoryBucket([])
+    names = ["realtime-20201223-190003", "realtime-20201223-191503"]
+    for name, record in zip(names, lst):
+        shard = append_to_shard(bucket, "realtime", name, json.dumps(record), 'hour')
+        assert shard.name == shard_name("realtime", shard_period(name, 'hour'))
+
+    assert list(bucket.blobs) == [shard.name]
+    assert shard.component_count == 2
+    assert list(parse_shard(shard.payload)) == names
+
+
+def test_append_to_shard_retries_conflicts():
+    bucket = MemoryBucket([])
+    append_to_shard(bucket, "realtime", "realtime-20201223-190003",
+                    json.dumps(lst[0]), 'hour')
+    bucket.conflicts = 2
+    shard = append_to_shard(bucket, "realtime", "realtime-20201223-191503",
+                            json.dumps(lst[1]), 'hour')
+    assert len(parse_shard(shard.payload)) == 2
+
+    # Every attempt conflicting, nothing is appended and the part is gone.
+    before = shard.payload
+    bucket.conflicts = 100
+    assert append_to_shard(bucket, "realtime", "realtime-20201223-193003",
+                           json.dumps(lst[2]), 'hour') is None
+    assert list(bucket.blobs) == [shard.name]
+    assert shard.payload == before
+
+
+def test_append_to_shard_rewrites_before_component_limit():
+    bucket = MemoryBucket([])
+    shard = append_to_shard(bucket, "realtime", "realtime-20201223-190003",
+                            json.dumps(lst[0]), 'hour')
+    shard.component_count = SHARD_MAX_COMPONENTS
+    shard = append_to_shard(bucket, "realtime", "realtime-20201223-191503",
+                            json.dumps(lst[1]), 'hour')
+
+    assert shard.component_count is None
+    assert len(parse_shard(shard.payload)) == 2
+    assert list(bucket.blobs) == [shard.name]
+
+
+def test_update_manifest():
+    bucket = MemoryBucket([])
+    rebuilt = []
+
+    def rebuild(prefix):
+        rebuilt.append(prefix)
+        return Manifest(prefix)
+
+    def add(name):
+        return lambda manifest: manifest.add(name, generation=1)
+
+    update_manifest(bucket, "realtime", add("realtime-20201223-190003"), "", rebuild)
+    bucket.conflicts = 1
+    manifest = update_manifest(bucket, "realtime", add("realtime-20201223-191503"),
+                               "", rebuild)
+    assert rebuilt == ["realtime"]
+    assert len(manifest) == 2
+    blob = bucket.get_blob(MANIFEST_PREFIX + "realtime")
+    assert Manifest.loads(blob.payload).names == manifest.names
+
+    bucket.conflicts = MANIFEST_RETRIES
+    assert update_manifest(bucket, "realtime", add("realtime-20201223-193003"),
+                           "", rebuild) is None
+    assert len(Manifest.loads(blob.payload)) == 2
+
+
+def test_compressed_blobs_read_transparently():
+    data = json.dumps(lst).encode('utf-8')
+    compressed = compress(data, 'gzip')
+    assert len(compressed) < len(data) / 3
+
+    for size in (1, 3, 4096):
+        chunks = [compressed[i:i + size] for i in range(0, len(compressed), size)]
+        assert b''.join(decompress_chunks(chunks)) == data
+    assert b''.join(decompress_chunks([data[:2], data[2:]])) == data
+    assert list(decompress_chunks([])) == []
+
+    blobs = [MemoryBlob("hourly-20201223-100003", compressed, 1),
+             MemoryBlob("hourly-20201223-110003", data, 2)]
+    records = last_json(range(-1, -3, -1), blobs)
+    for record in records:
+        record.pop("name")
+    assert records[:len(lst)] == records[len(lst):]
+    assert records[0]["sunrise"]["value"] == '2020-12-23T07:24:53.968000-05:00'
+
+
+def hourly_forecasts():
+    # Three successive forecasts, an hour apart: the first target hour
+    # drops out, a new one comes in and a few values move.
+    base = copy.deepcopy(lst)
+    second = copy.deepcopy(base[1:]) + [copy.deepcopy(base[-1])]
+    second[-1]["observation_time"] = {"value": "2020-12-24T20:00:00.000Z"}
+    second[0]["temp"]["value"] += 1
+    second[1].pop("sunrise")
+    third = copy.deepcopy(second)
+    third[2]["humidity"] = {"value": 12.5, "units": "%"}
+    return base, second, third
+
+
+def test_forecast_delta_round_trip():
+    base, second, _ = hourly_forecasts()
+    delta = forecast_delta("hourly-20201223-100003", 1, base, second)
+
+    assert apply_delta(base, delta) == second
+    assert len(json.dumps(delta)) < len(json.dumps(second)) / 2
+    assert forecast_delta("hourly-20201223-100003", 1, base, {"temp": 1}) is None
+
+
+def test_delta_forecasts_read_in_full():
+    forecasts = hourly_forecasts()
+    names = ["hourly-20201223-100003", "hourly-20201223-110003", "hourly-20201223-120003"]
+    blobs = [MemoryBlob(names[0], json.dumps(forecasts[0]), 1)]
+    for i in (1, 2):
+        delta = forecast_delta(names[i - 1], i, forecasts[i - 1], forecasts[i])
+        blobs.append(MemoryBlob(names[i], json.dumps(delta), i + 1))
+    MemoryBucket(blobs)
+    full = [MemoryBlob("full-" + names[i], json.dumps(forecasts[i]), 10 + i) for i in (1, 2)]
+
+    cache = BlobCache(1 << 20)
+    records, _ = read_blob(blobs[2], cache)
+    assert records == read_blob(full[1], cache)[0]
+    assert read_blob(blobs[1], cache)[0] == read_blob(full[0], cache)[0]
+    assert blobs[2].reads == 1 and blobs[0].reads == 1
+
+    # Projected reads are rebuilt from the full forecast too, the delta
+    # is downloaded once.
+    fields = frozenset(["temp"])
+    reads = blobs[2].reads
+    records, _ = read_blob(blobs[2], BlobCache(1 << 20), fields)
+    assert records == [{"temp": r["temp"]} for r in forecasts[2]]
+    assert blobs[2].reads == reads + 1
+    records, _ = read_blob(blobs[2], BlobCache(1 << 20), frozenset(["sunrise"]))
+    assert records == [{"sunrise": r["sunrise"]} if "sunrise" in r else {}
+                       for r in scan_and_apply_tz(forecasts[2])]
+
+
+def test_delta_chain_read_once():
+    # A keyframe and 23 deltas, each forecast one degree warmer.
+    names = ["hourly-20210105-{:02d}0003".format(h) for h in range(24)]
+    forecast = copy.deepcopy(lst)
+    blobs = [MemoryBlob(names[0], json.dumps(forecast), 100)]
+    for i in range(1, 24):
+        previous = forecast
+        forecast = copy.deepcopy(previous)
+        forecast[0]["temp"]["value"] += 1
+        delta = forecast_delta(names[i - 1], 99 + i, previous, forecast)
+        blobs.append(MemoryBlob(names[i], json.dumps(delta), 100 + i))
+    MemoryBucket(blobs)
+
+    records = last_json(range(-1, -25, -1), blobs, concurrency=1)
+
+    assert sum(blob.reads for blob in blobs) == 24
+    assert records[0]["temp"]["value"] == lst[0]["temp"]["value"] + 23
+    assert records[-len(lst)]["temp"]["value"] == lst[0]["temp"]["value"]
+
+
+def test_write_behind_retries_and_drains():
+    written = []
+    attempts = {}
+
+    def write(prefix, name, payload):
+        attempts[name] = attempts.get(name, 0) + 1
+        if name == "flaky" and attempts[name] < 3:
+            raise IOError("503 from GCS")
+        if name == "broken":
+            return None
+        time.sleep(0.01)
+        written.append(name)
+        return name
+
+    failed = []
+    writes = WriteBehind(write, workers=2, max_queue=8, retries=3, backoff=0.001,
+                         failed=lambda *args: failed.append(args))
+    for name in ["a", "flaky", "b", "broken"]:
+        assert writes.submit("realtime", name, "{}")
+
+    assert writes.drain(timeout=5)
+    assert sorted(written) == ["a", "b", "flaky"]
+    assert failed == [("realtime", "broken", "{}")]
+    assert not writes.submit("realtime", "late", "{}")
+
+    stats = writes.stats()
+    assert (stats["written"], stats["retried"], stats["failed"], stats["rejected"]) == (3, 5, 1, 1)
+    assert stats["depth"] == 0 and stats["upload_seconds"]["count"] == 3
+
+
+def test_write_behind_rejects_when_full():
+    release = threading.Event()
+    writes = WriteBehind(lambda *args: release.wait(), workers=1, max_queue=1)
+
+    assert writes.submit("hourly", "a", "{}")
+    time.sleep(0.05)  # taken by the worker
+    assert writes.submit("hourly", "b", "{}")
+    assert not writes.submit("hourly", "c", "{}")
+    assert not writes.drain(timeout=0.05)
+
+    release.set()
+    assert writes.drain(timeout=5)
+    assert writes.stats()["written"] == 2
+
+
+def test_normalized_blobs_are_not_converted():
+    payload, schema = normalize_payload(json.dumps(lst[0]))
+    assert schema == TZ_SCHEMA
+    assert json.loads(payload)["sunrise"]["value"] == '2020-12-23T07:24:53.968000-05:00'
+    # Normalizing is idempotent, legacy blobs holding Toronto time are fine.
+    assert normalize_payload(payload)[0] == payload
+    assert normalize_payload("not json") == ("not json", None)
+
+    # A normalized blob is read as stored: its UTC value is left alone.
+    names = ["realtime-20201223-191503", "realtime-20201223-193003"]
+    blobs = [MemoryBlob(names[0], json.dumps(lst[0]), 1),
+             MemoryBlob(names[1], json.dumps(lst[0]), 2)]
+    bucket = MemoryBucket(blobs)
+    manifest = Manifest("realtime")
+    manifest.add(names[0], generation=1)
+    manifest.add(names[1], generation=2, schema=TZ_SCHEMA)
+    manifest = Manifest.loads(manifest.dumps())
+    blobs = BucketBlobs(bucket, manifest.names, manifest.generations,
+                        schemas=manifest.schemas)
+
+    records = last_json(range(-1, -3, -1), blobs)
+    assert records[0]["sunrise"] == lst[0]["sunrise"]
+    assert records[1]["sunrise"]["value"] == '2020-12-23T07:24:53.968000-05:00'
+
+
+def test_partitioned_names():
+    dt = datetime(2020, 12, 23, 19, 15, 3)
+    name = stamp_name("realtime", dt, 'partitioned')
+
+    assert name == "realtime/2020/12/23/realtime-20201223-191503"
+    assert stamp_name("realtime", dt) == "realtime-20201223-191503"
+    assert name_to_datetime(name) == dt
+    assert stamp_days("20201230-230000", "20210102-000000") == \
+        ["20201230", "20201231", "20210101", "20210102"]
+
+
+def test_manifest_mixes_layouts_in_time_order():
+    flat = ["realtime-20201223-190003", "realtime-20201224-191503"]
+    partitioned = ["realtime/2020/12/23/realtime-20201223-193003",
+                   "realtime/2020/12/24/realtime-20201224-000003"]
+    # An old manifest, sorted by name only.
+    manifest = Manifest.loads(json.dumps({
+        "prefix": "realtime", "names": sorted(flat + partitioned),
+        "times": [None] * 4, "sizes": [1, 2, 3, 4]}))
+
+    expected = [flat[0], partitioned[0], partitioned[1], flat[1]]
+    assert manifest.names == expected
+    assert manifest.sizes == [1, 3, 4, 2]
+    assert manifest.day_names("20201224") == expected[2:]
+    assert manifest.index(partitioned[1]) == 2 and manifest.index("realtime-x") is None
+    assert manifest.after(partitioned[0]) == expected[2:]
+    assert list(resolve_range(manifest.keys, "2020-12-23T19:20:00Z", "2020-12-24T20:00:00Z")) == [3, 2, 1]
+
+    manifest.add("realtime/2020/12/23/realtime-20201223-194503")
+    assert manifest.names[2] == "realtime/2020/12/23/realtime-20201223-194503"
+
+    index = SlotIndex()
+    for name in reversed(expected):
+        index.add(name)
+    assert index.newest == flat[1]
+
+
+def test_list_range_merges_layouts():
+    listing = MemoryListing([
+        "realtime-20201222-230003", "realtime-20201223-190003",
+        "realtime-20201224-191503", "realtime/2020/12/22/realtime-20201222-233003",
+        "realtime/2020/12/23/realtime-20201223-193003",
+        "realtime/2020/12/24/realtime-20201224-000003",
+        "realtime/2020/12/25/realtime-20201225-000003"])
+
+    blobs = list_range(listing, "realtime", "20201223-000000", "20201224-191503")
+    assert listing.calls == ["realtime-", "realtime/2020/12/23/", "realtime/2020/12/24/"]
+    assert listed_blobs(None, blobs).names == [
+        "realtime-20201223-190003", "realtime/2020/12/23/realtime-20201223-193003",
+        "realtime/2020/12/24/realtime-20201224-000003"]
+
+    # Without hi the range ends now.
+    blobs = list_range(listing, "realtime", "20201224-000000",
+                       now=datetime(2020, 12, 25, 12))
+    assert len(blobs) == 3
+    assert len(list_range(listing, "realtime")) == 7
+
+
+def test_list_range_excludes_midnight_bound():
+    listing = MemoryListing(["realtime-20201224-000000",
+                             "realtime/2020/12/24/realtime-20201224-000000",
+                             "realtime/2020/12/23/realtime-20201223-235959"])
+
+    blobs = list_range(listing, "realtime", "20201223-000000", "20201224-000000")
+    assert [blob.name for blob in blobs] == ["realtime/2020/12/23/realtime-20201223-235959"]
+    # The day of the exclusive bound isn't listed at all.
+    assert listing.calls == ["realtime-", "realtime/2020/12/23/"]
+
+
+def test_list_blob_last_doubles_windows():
+    listing = MemoryListing([
+        "realtime/2020/12/25/realtime-20201225-100003",
+        "realtime/2020/12/23/realtime-20201223-100003",
+        "realtime-20201220-100003", "realtime/2020/12/19/realtime-20201219-100003",
+        "realtime-20201201-100003"])
+    now = datetime(2020, 12, 25, 12)
+
+    blobs = list_blob_last(listing, "realtime", 1, now)
+    assert [blob.name for blob in blobs] == ["realtime/2020/12/25/realtime-20201225-100003"]
+
+    # 1, 2, 4 then 8 days back, each window listing only the new days.
+    listing.calls = []
+    blobs = list_blob_last(listing, "realtime", 4, now)
+    days = [call for call in listing.calls if call != "realtime-"]
+    assert days == ["realtime/2020/12/{}/".format(day)
+                    for day in (24, 25, 23, 21, 22, 17, 18, 19, 20)]
+    assert len(listing.calls) - len(days) == 4
+    assert listed_blobs(None, blobs).names == [
+        "realtime/2020/12/19/realtime-20201219-100003", "realtime-20201220-100003",
+        "realtime/2020/12/23/realtime-20201223-100003",
+        "realtime/2020/12/25/realtime-20201225-100003"]
+
+    # Not enough blobs in any window, the whole prefix is listed.
+    assert len(list_blob_last(listing, "realtime", 10, now)) == 5
@@ -1,5 +1,7 @@
+from bisect import bisect_right
 from datetime import datetime, timedelta
-import math
+from functools import lru_cache
+import numpy as np
 from pytz import timezone
 import pytz
 from dateutil.parser import parse
@@ -7,13 +9,105 @@ from dateutil.parser import parse
 tz = timezone('America/Toronto')
 tz_utc = timezone('UTC')
 
+# ClimaCell fields holding a timestamp. Everything else in a payload
+# (measurements, units, enums) is passed through untouched.
+TZ_FIELDS = frozenset([
+    'observation_time',
+    'sunrise',
+    'sunset',
+    'start_time',
+    'end_time',
+])
+
+# America/Toronto transition table, straight from pytz so results match
+# pytz exactly: UTC instants (epoch seconds) where the offset changes, the
+# offset (seconds) in effect from each of them and the matching pytz
+# tzinfo (EST, EDT, ...).
+_TRANSITION_SECONDS = np.array(tz._utc_transition_times,
+                               dtype='datetime64[s]').astype('int64')
+_TRANSITION_OFFSETS = np.array(
+    [int(info[0].total_seconds()) for info in tz._transition_info],
+    dtype='int64')
+_TRANSITION_LIST = _TRANSITION_SECONDS.tolist()
+_TRANSITION_TZINFOS = [tz._tzinfos[info] for info in tz._transition_info]
+
+_EPOCH = datetime(1970, 1, 1)
+_SECOND = timedelta(seconds=1)
+
+
+def _transition_at(seconds):
+    return max(0, bisect_right(_TRANSITION_LIST, seconds) - 1)
+
+
+@lru_cache(maxsize=4096)
+def _hour_offset(hour):
+    # (offset, tzinfo) for a whole UTC hour, None when the offset changes
+    # within that hour.
+    idx = _transition_at(hour * 3600)
+    if idx != _transition_at(hour * 3600 + 3599):
+        return None
+    return int(_TRANSITION_OFFSETS[idx]), _TRANSITION_TZINFOS[idx]
+
+
+def _offset_at(seconds):
+    # UTC offset (seconds) and tzinfo in effect at an epoch second.
+    cached = _hour_offset(seconds // 3600)
+    if cached is not None:
+        return cached
+    idx = _transition_at(seconds)
+    return int(_TRANSITION_OFFSETS[idx]), _TRANSITION_TZINFOS[idx]
+
+
+def _to_seconds(naive):
+    # Whole seconds since the epoch and the leftover microseconds.
+    delta = naive - _EPOCH
+    return delta.days * 86400 + delta.seconds, delta.microseconds
+
+
+def _from_seconds(seconds, microsecond=0):
+    offset, tzinfo = _offset_at(seconds)
+    local = _EPOCH + timedelta(seconds=seconds + offset,
+                               microseconds=microsecond)
+    return local.replace(tzinfo=tzinfo)
+
+
+def _wall_to_seconds(wall):
+    # Toronto wall-clock seconds to UTC seconds. Like pytz localize(), an
+    # ambiguous wall time resolves to standard time, a skipped one is
+    # taken with the standard offset (02:30 on spring forward is 03:30 EDT).
+    candidates = []
+    for guess in (wall - 86400, wall + 86400):
+        offset, tzinfo = _offset_at(guess)
+        if offset not in (c[0] for c in candidates):
+            candidates.append((offset, tzinfo))
+
+    valid = [c for c in candidates if _offset_at(wall - c[0])[0] == c[0]]
+    for offset, tzinfo in (valid or candidates):
+        if not tzinfo._dst:
+            return wall - offset
+    return wall - (valid or candidates)[0][0]
+
 
 def ceil_dt(dt, delta):
-    ceil = datetime.min + math.ceil(
-        (dt.replace(tzinfo=None) - datetime.min) /
-        timedelta(minutes=delta)) * timedelta(minutes=delta)
+    # Round up to the next `delta` minutes slot of Toronto wall-clock time.
+    # Naive datetimes are taken as Toronto wall-clock time. Done with plain
+    # integer arithmetic on epoch seconds and the cached offsets.
+    step = delta * 60
 
-    return ceil.replace(tzinfo=tz)
+    if dt.tzinfo is None or dt.tzinfo.utcoffset(dt) is None:
+        wall, micro = _to_seconds(dt)
+        offset = None
+    else:
+        utc, micro = _to_seconds(dt.replace(tzinfo=None) - dt.utcoffset())
+        offset = _offset_at(utc)[0]
+        wall = utc + offset
+
+    if wall % step or micro:
+        wall = (wall // step + 1) * step
+
+    if offset is None:
+        return _from_seconds(_wall_to_seconds(wall))
+    return _from_seconds(wall - offset)
 
 
 def utcnow():
@@ -28,33 +122,140 @@ def get_utc_tz():
 
 def utc_to_toronto(dt):
     if dt.tzinfo is None or dt.tzinfo.utcoffset(dt) is None:
-        dt = tz_utc.localize(dt).astimezone(tz)
+        utc = dt
     else:
-        dt = dt.astimezone(tz)
-    return dt
+        utc = dt.replace(tzinfo=None) - dt.utcoffset()
+    seconds, micro = _to_seconds(utc)
+    return _from_seconds(seconds, micro)
 
 
-def scan_and_apply_tz(dictio):
+def _epoch_seconds(instants):
+    if np.issubdtype(instants.dtype, np.datetime64):
+        return (instants - np.datetime64(0, 's')) // np.timedelta64(1, 's')
+    return instants.astype('int64')
 
-    if isinstance(dictio, dict):
-        for i in dictio.keys():
-            dictio[i] = scan_and_apply_tz(dictio[i])
-    if isinstance(dictio, list):
-        for idx,i in enumerate(dictio):
-            i2 = scan_and_apply_tz(i)
-            dictio[idx] = i2
 
-    if isinstance(dictio, datetime):
-        dictio2 = utc_to_toronto(dictio)
+def toronto_offsets(instants):
+    # UTC offsets (seconds) for an array of UTC instants, either datetime64
+    # or epoch seconds.
+    seconds = _epoch_seconds(np.asarray(instants))
+    idx = np.searchsorted(_TRANSITION_SECONDS, seconds, side='right') - 1
+    return _TRANSITION_OFFSETS[np.maximum(idx, 0)]
 
-        return dictio2
-    else:
+
+def utc_to_toronto_batch(instants):
+    # Batch utc_to_toronto: UTC instants (datetime64 or epoch seconds) to
+    # Toronto wall-clock datetime64, keeping the input resolution
+    # (seconds for epoch ints). Pair with toronto_offsets() for the offsets.
+    instants = np.asarray(instants)
+    offsets = toronto_offsets(instants).astype('timedelta64[s]')
+    if not np.issubdtype(instants.dtype, np.datetime64):
+        instants = instants.astype('int64').astype('datetime64[s]')
+    return instants + offsets
+
+
+def parse_iso(value):
+    # Strict ISO-8601 fast path, ClimaCell sends '2020-12-23T19:15:01.835Z'.
+    # Returns None when the string is not in that format.
+    if value.endswith('Z'):
+        value = value[:-1] + '+00:00'
+    try:
+        return datetime.fromisoformat(value)
+    except ValueError:
+        return None
+
+
+# Timestamp strings repeat a lot (sunrise/sunset in every hourly element,
+# the same blobs read on every /store/* GET). lru_cache is bounded, thread
+# safe and keeps the hit/miss counters, see timestamp_cache_info().
+TIMESTAMP_CACHE_SIZE = 8192
+
+
+@lru_cache(maxsize=TIMESTAMP_CACHE_SIZE)
+def _to_toronto_iso(value):
+    parsed = parse_iso(value)
+    if parsed is None:
+        # Not strict ISO, give dateutil a chance before giving up.
         try:
-            parsed = parse(dictio)
-            dictio2 = utc_to_toronto(parsed).isoformat()
-        except (ValueError, TypeError):
-            return dictio
-            
-        return dictio2
+            parsed = parse(value)
+        except (ValueError, OverflowError):
+            return value
+
+    return utc_to_toronto(parsed).isoformat()
+
+
+def timestamp_cache_info():
+    return _to_toronto_iso.cache_info()
+
+
+def timestamp_cache_clear():
+    _to_toronto_iso.cache_clear()
 
+
+def convert_timestamp(value):
+    if isinstance(value, datetime):
+        return utc_to_toronto(value)
+    if not isinstance(value, str):
+        return value
+
+    return _to_toronto_iso(value)
+
+
+def _apply_tz_leaves(dictio):
+    # Everything below a timestamp field, usually {"value": "..."}.
+    # Containers are copied, the input is left untouched.
+    root = [dictio]
+    stack = [(root, 0)]
+    while stack:
+        parent, k = stack.pop()
+        node = parent[k]
+        if isinstance(node, dict):
+            node = dict(node)
+            parent[k] = node
+            stack.extend((node, i) for i in node)
+        elif isinstance(node, list):
+            node = list(node)
+            parent[k] = node
+            stack.extend((node, i) for i in range(len(node)))
+        else:
+            parent[k] = convert_timestamp(node)
+
+    return root[0]
+
+
+def tz_object_hook(dictio, fields=TZ_FIELDS):
+    # json object_hook: converts the timestamp fields while a document is
+    # being decoded, the dict is fresh from the decoder so it is updated
+    # in place.
+    for i in fields.intersection(dictio):
+        dictio[i] = _apply_tz_leaves(dictio[i])
     return dictio
+
+
+def scan_and_apply_tz(dictio, fields=TZ_FIELDS):
+    # Returns a converted copy, the input is left untouched. Only the
+    # subtrees of the timestamp fields (and datetime values) are converted,
+    # the other containers are copied on the way down and their leaves
+    # passed through. Nothing recurses, so deeply nested payloads are fine.
+    root = [dictio]
+    stack = [(root, 0)]
+    while stack:
+        parent, k = stack.pop()
+        node = parent[k]
+        if isinstance(node, dict):
+            node = dict(node)
+            parent[k] = node
+            for i, value in node.items():
+                if i in fields:
+                    node[i] = _apply_tz_leaves(value)
+                elif isinstance(value, (dict, list, datetime)):
+                    stack.append((node, i))
+        elif isinstance(node, list):
+            node = list(node)
+            parent[k] = node
+            stack.extend((node, i) for i, value in enumerate(node)
+                         if isinstance(value, (dict, list, datetime)))
+        elif isinstance(node, datetime):
+            parent[k] = utc_to_toronto(node)
+
+    return root[0]
@@ -4,8 +4,11 @@ pip install -U pytest
 > pytest
 '''
 
-from utils import utcnow, ceil_dt, tz, utc_to_toronto, iterate_keys_for_datetime
-from datetime import datetime
+from yadt import utcnow, ceil_dt, tz, utc_to_toronto, scan_and_apply_tz, convert_timestamp, \
+    timestamp_cache_info, timestamp_cache_clear, utc_to_toronto_batch, toronto_offsets
+import copy
+from datetime import datetime, timedelta
+import numpy as np
 from pytz import timezone
 import pytz
 
@@ -14,28 +17,86 @@ def test_ceil_dt_15():
     dt = utcnow().replace(minute=12)
     test = ceil_dt(dt, 15)
     assert test.minute == 15
-    assert test.tzinfo == tz
+    assert test.tzinfo.zone == tz.zone
+    assert test.tzname() in ('EST', 'EDT')
 
 
 def test_ceil_dt_30():
     dt = utcnow().replace(minute=22)
     test = ceil_dt(dt, 15)
     assert test.minute == 30
-    assert test.tzinfo == tz
+    assert test.tzinfo.zone == tz.zone
+    assert test.tzname() in ('EST', 'EDT')
 
 
 def test_ceil_dt_45():
     dt = utcnow().replace(minute=33)
     test = ceil_dt(dt, 15)
     assert test.minute == 45
-    assert test.tzinfo == tz
+    assert test.tzinfo.zone == tz.zone
+    assert test.tzname() in ('EST', 'EDT')
 
 
 def test_ceil_dt_00():
     dt = utcnow().replace(minute=46)
     test = ceil_dt(dt, 15)
     assert test.minute == 0
-    assert test.tzinfo == tz
+    assert test.tzinfo.zone == tz.zone
+    assert test.tzname() in ('EST', 'EDT')
+
+def reference_ceil_dt(dt, delta):
+    # Reference slot alignment with pytz: round the UTC instant up (Toronto
+    # offsets are whole hours) and let pytz pick the offset.
+    utc = dt.astimezone(pytz.utc).replace(tzinfo=None)
+    step = timedelta(minutes=delta)
+    ceiled = datetime.min + -((datetime.min - utc) // step) * step
+    return pytz.utc.localize(ceiled).astimezone(tz)
+
+
+def dst_days_minutes():
+    # Every minute of the 2020 and 2021 transition days, in UTC.
+    for day in (datetime(2020, 3, 8), datetime(2020, 11, 1),
+                datetime(2021, 3, 14), datetime(2021, 11, 7)):
+        for minute in range(0, 24 * 60 + 1):
+            yield day + timedelta(minutes=minute, seconds=7)
+
+
+def test_ceil_dt_matches_reference_across_dst():
+    for utc in dst_days_minutes():
+        dt = pytz.utc.localize(utc).astimezone(tz)
+        test = ceil_dt(dt, 15)
+        reference = reference_ceil_dt(dt, 15)
+        assert test == reference
+        assert test.tzname() == reference.tzname()
+        assert test.utcoffset() == reference.utcoffset()
+        assert test.minute % 15 == 0 and test.second == 0
+
+
+def test_ceil_dt_naive_matches_localize():
+    for utc in dst_days_minutes():
+        wall = utc - timedelta(hours=5)
+        test = ceil_dt(wall, 15)
+        step = timedelta(minutes=15)
+        ceiled = datetime.min + -((datetime.min - wall) // step) * step
+        reference = tz.normalize(tz.localize(ceiled))
+        assert test == reference
+        assert test.tzname() == reference.tzname()
+
+
+def test_ceil_dt_spring_forward():
+    # 01:50 EST, the next slot is 02:00 EST which is 03:00 EDT.
+    test = ceil_dt(tz.localize(datetime(2020, 3, 8, 1, 50)), 15)
+    assert test.replace(tzinfo=None) == datetime(2020, 3, 8, 3, 0)
+    assert test.tzname() == 'EDT'
+
+
+def test_utc_to_toronto_matches_pytz_across_dst():
+    for utc in dst_days_minutes():
+        test = utc_to_toronto(utc)
+        reference = pytz.utc.localize(utc).astimezone(tz)
+        assert test == reference
+        assert test.tzinfo is reference.tzinfo
+
 
 def test_naive_to_toronto():
     dt = datetime.strptime("20201223 101010","%Y%m%d %H%M%S")
@@ -74,14 +135,106 @@ def test_toronto_to_toronto():
 
 
 
-def test_iterate_keys_for_datetime():
+def test_batch_matches_scalar_across_dst():
+    start = datetime(2020, 1, 1)
+    instants = [start + timedelta(minutes=15 * i) for i in range(4 * 24 * 366)]
+    # Both sides of each transition, to the second.
+    for transition in (datetime(2020, 3, 8, 7), datetime(2020, 11, 1, 6)):
+        instants += [transition - timedelta(seconds=1), transition,
+                     transition + timedelta(seconds=1)]
+
+    local = utc_to_toronto_batch(np.array(instants, dtype='datetime64[us]'))
+    offsets = toronto_offsets(np.array(instants, dtype='datetime64[us]'))
+
+    for dt, l, o in zip(instants, local, offsets):
+        scalar = utc_to_toronto(dt)
+        assert l.astype(datetime) == scalar.replace(tzinfo=None)
+        assert o == scalar.utcoffset().total_seconds()
+
+
+def test_batch_epoch_seconds():
+    local = utc_to_toronto_batch(np.array([1604210399, 1604210400]))
+
+    assert local[0] == np.datetime64('2020-11-01T01:59:59')
+    assert local[1] == np.datetime64('2020-11-01T01:00:00')
 
-    conv = iterate_keys_for_datetime(lst)
+
+def test_scan_and_apply_tz():
+
+    conv = scan_and_apply_tz(copy.deepcopy(lst))
 
     assert conv[0]["observation_time"][
         "value"] == '2020-12-23T14:15:01.835000-05:00'
 
 
+def test_scan_and_apply_tz_leaves_other_fields():
+
+    conv = scan_and_apply_tz(copy.deepcopy(lst))
+
+    assert conv[0]["sunrise"]["value"] == '2020-12-23T07:24:53.968000-05:00'
+    assert conv[0]["temp"] == lst[0]["temp"]
+    assert conv[0]["wind_speed"]["units"] == 'm/s'
+    assert conv[-1]["weather_code"]["value"] == 'mostly_cloudy'
+    assert conv[-1]["name"] == 'realtime-20201222-121503'
+
+
+def test_convert_timestamp_fallback():
+    assert convert_timestamp("Wed, 21 Oct 2015 18:27:50 GMT") == '2015-10-21T14:27:50-04:00'
+    assert convert_timestamp("mostly_cloudy") == 'mostly_cloudy'
+    assert convert_timestamp(None) is None
+
+
+def test_convert_timestamp_cached():
+    timestamp_cache_clear()
+
+    first = convert_timestamp("2020-12-23T12:24:53.968Z")
+    second = convert_timestamp("2020-12-23T12:24:53.968Z")
+
+    assert first == second == '2020-12-23T07:24:53.968000-05:00'
+    assert timestamp_cache_info().misses == 1
+    assert timestamp_cache_info().hits == 1
+
+def test_scan_and_apply_tz_long_list():
+    longer = copy.deepcopy(lst + lst)
+
+    conv = scan_and_apply_tz(longer)
+    assert conv[len(lst)]["observation_time"][
+        "value"] == '2020-12-23T14:15:01.835000-05:00'
+
+
+def test_scan_and_apply_tz_mixed_list():
+    mixed = [{"temp": 1}, {"observation_time": {"value": "2020-12-23T20:00:00Z"}},
+             {"sunset": {"value": "2020-12-23T20:43:45Z"}, "temp": 2}]
+
+    conv = scan_and_apply_tz(mixed)
+
+    assert conv[0] == {"temp": 1}
+    assert conv[1]["observation_time"]["value"] == '2020-12-23T15:00:00-05:00'
+    assert conv[2]["sunset"]["value"] == '2020-12-23T15:43:45-05:00'
+
+
+def test_scan_and_apply_tz_leaves_input_alone():
+    original = copy.deepcopy(lst)
+
+    conv = scan_and_apply_tz(lst)
+
+    assert lst == original
+    assert conv is not lst
+    assert conv[0]["sunset"]["value"] == '2020-12-23T15:43:45.815000-05:00'
+
+
+def test_scan_and_apply_tz_deep_nesting():
+    deep = {"observation_time": {"value": "2020-12-23T19:15:01.835Z"}}
+    for _ in range(5000):
+        deep = [{"wrap": deep}]
+
+    conv = scan_and_apply_tz(deep)
+
+    for _ in range(5000):
+        conv = conv[0]["wrap"]
+    assert conv["observation_time"]["value"] == '2020-12-23T14:15:01.835000-05:00'
+
+
 lst = [{
     "lat": 48.400643,
     "lon": -68.646753,